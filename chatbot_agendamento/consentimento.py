@@ -70,15 +70,15 @@ def handle_delete_choice(update, context):
         email = context.user_data.get("last_email")
         if email:
             # Cancel all future events for this email
-            from handlers import agendamento
-            events, total = agendamento.get_user_events(email, page=0, page_size=1000)
-            for event in events:
-                try:
-                    service = agendamento.get_calendar_service()
-                    if service:
-                        service.events().delete(calendarId=agendamento.CALENDAR_ID, eventId=event['id']).execute()
-                except Exception as e:
-                    logger.error(f"Erro ao deletar evento {event.get('summary')} do usuário {user_id}: {e}")
+            from utils.google_calendar import listar_eventos_por_email, excluir_eventos
+            # Exclui todos os eventos em lotes (poucas requisições HTTP em vez de uma por evento)
+            try:
+                falhas = excluir_eventos([event['id'] for event in listar_eventos_por_email(email)])
+            except Exception as e:
+                logger.error(f"Erro ao deletar eventos do usuário {user_id}: {e}")
+                falhas = {}
+            for event_id, erro in falhas.items():
+                logger.error(f"Erro ao deletar evento {event_id} do usuário {user_id}: {erro}")
         # Clear context user data
         context.user_data.clear()
         # Confirm deletion to user
@@ -2,15 +2,41 @@
 from datetime import datetime, timedelta
 from googleapiclient.discovery import build
 from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp, Request
+import httplib2
+import threading
 import os
 
 SCOPES = ['https://www.googleapis.com/auth/calendar']
 SERVICE_ACCOUNT_FILE = 'json/service_account.json'
 CALENDAR_ID = os.getenv('GOOGLE_CALENDAR_ID')
+HTTP_TIMEOUT = int(os.getenv('CALENDAR_HTTP_TIMEOUT', 15))
+MARGEM_RENOVACAO_TOKEN = timedelta(minutes=5)
+TAMANHO_LOTE = 50
 
-credentials = service_account.Credentials.from_service_account_file(
-    SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-service = build('calendar', 'v3', credentials=credentials)
+_credentials = None
+_credentials_lock = threading.Lock()
+_local = threading.local()
+
+def obter_credenciais():
+    global _credentials
+    with _credentials_lock:
+        if _credentials is None:
+            _credentials = service_account.Credentials.from_service_account_file(
+                SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+        expiracao = _credentials.expiry
+        if not _credentials.valid or (expiracao and expiracao - datetime.utcnow() < MARGEM_RENOVACAO_TOKEN):
+            _credentials.refresh(Request(httplib2.Http(timeout=HTTP_TIMEOUT)))
+        return _credentials
+
+def obter_servico():
+    credenciais = obter_credenciais()
+    servico = getattr(_local, 'service', None)
+    if servico is None:
+        http = AuthorizedHttp(credenciais, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+        servico = build('calendar', 'v3', http=http, cache_discovery=False)
+        _local.service = servico
+    return servico
 
 def obter_dias_disponiveis(numero_dias=7):
     hoje = datetime.utcnow().date()
@@ -20,7 +46,7 @@ def obter_horarios_disponiveis(dia):
     inicio_dia = datetime.strptime(dia, '%Y-%m-%d').isoformat() + 'Z'
     fim_dia = (datetime.strptime(dia, '%Y-%m-%d') + timedelta(days=1)).isoformat() + 'Z'
 
-    eventos = service.events().list(
+    eventos = obter_servico().events().list(
         calendarId=CALENDAR_ID,
         timeMin=inicio_dia,
         timeMax=fim_dia,
@@ -48,5 +74,42 @@ def salvar_evento_google(nome, telefone, email, dia, hora):
             'timeZone': 'America/Sao_Paulo',
         },
     }
-    criado = service.events().insert(calendarId=CALENDAR_ID, body=evento).execute()
+    criado = obter_servico().events().insert(calendarId=CALENDAR_ID, body=evento).execute()
     return criado
+
+def executar_em_lote(servico, requisicoes, tamanho_lote=TAMANHO_LOTE):
+    """Executa [(id, requisição)] em lotes do Calendar; retorna {id: (resposta, erro)} por item."""
+    resultados = {}
+    def coletar(request_id, resposta, erro):
+        resultados[request_id] = (resposta, erro)
+    for i in range(0, len(requisicoes), tamanho_lote):
+        lote = servico.new_batch_http_request(callback=coletar)
+        for request_id, requisicao in requisicoes[i:i + tamanho_lote]:
+            lote.add(requisicao, request_id=request_id)
+        lote.execute()
+    return resultados
+
+def listar_eventos_por_email(email):
+    servico = obter_servico()
+    eventos, page_token = [], None
+    while True:
+        resultado = servico.events().list(
+            calendarId=CALENDAR_ID,
+            q=email,
+            timeMin=datetime.utcnow().isoformat() + 'Z',
+            singleEvents=True,
+            pageToken=page_token,
+        ).execute()
+        eventos.extend(resultado.get('items', []))
+        page_token = resultado.get('nextPageToken')
+        if not page_token:
+            return eventos
+
+def excluir_eventos(ids_eventos):
+    """Exclui eventos em lote; retorna {id: erro} só dos que falharam."""
+    servico = obter_servico()
+    resultados = executar_em_lote(servico, [
+        (id_evento, servico.events().delete(calendarId=CALENDAR_ID, eventId=id_evento))
+        for id_evento in ids_eventos
+    ])
+    return {id_evento: erro for id_evento, (_, erro) in resultados.items() if erro is not None}
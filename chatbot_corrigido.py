@@ -1,11 +1,20 @@
 import os
 import json
+import random
+import asyncio
+import functools
 import re
 import calendar
 import smtplib
+import sqlite3
+import hashlib
+import hmac
 import logging
+import time
 import traceback
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import Future, ThreadPoolExecutor
+from array import array
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
@@ -22,11 +31,18 @@ from telegram.ext import (
 from telegram.error import TimedOut, BadRequest
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from google_auth_httplib2 import AuthorizedHttp, Request as AuthorizedRequest
+import httplib2
 from sentence_transformers import SentenceTransformer, util
 import numpy as np
-from cachetools import TTLCache
+from cachetools import Cache, TTLCache
 import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
 import redis
+import redis.asyncio as aioredis
+from chatbot_agendamento.utils.google_calendar import executar_em_lote
 
 # --- CONFIGURAÇÃO DE LOGS ---
 logging.basicConfig(
@@ -40,6 +56,16 @@ load_dotenv(encoding='utf-8')
 TOKEN = os.getenv("TELEGRAM_TOKEN")
 MEMORY_FILE = "json/memory.json"
 SERVICE_ACCOUNT_FILE = "json/service_account.json"
+CALENDAR_SCOPES = ["https://www.googleapis.com/auth/calendar"]
+CALENDAR_HTTP_TIMEOUT = int(os.getenv("CALENDAR_HTTP_TIMEOUT", 15))
+CALENDAR_TOKEN_REFRESH_MARGIN_SECONDS = int(os.getenv("CALENDAR_TOKEN_REFRESH_MARGIN_SECONDS", 300))
+CALENDAR_MAX_WORKERS = int(os.getenv("CALENDAR_MAX_WORKERS", 4))
+CALENDAR_MAX_CONCURRENCY = int(os.getenv("CALENDAR_MAX_CONCURRENCY", 4))
+CALENDAR_CALL_TIMEOUT = float(os.getenv("CALENDAR_CALL_TIMEOUT", 20))
+CALENDAR_BATCH_SIZE = int(os.getenv("CALENDAR_BATCH_SIZE", 50))
+CALENDAR_BREAKER_THRESHOLD = int(os.getenv("CALENDAR_BREAKER_THRESHOLD", 5))
+CALENDAR_BREAKER_COOLDOWN = int(os.getenv("CALENDAR_BREAKER_COOLDOWN", 30))
+AVAILABILITY_STALE_TIMEOUT = float(os.getenv("AVAILABILITY_STALE_TIMEOUT", 1.5))
 CALENDAR_ID = os.getenv("GOOGLE_CALENDAR_ID")
 EMAIL_HOST = os.getenv("EMAIL_HOST", "smtp.gmail.com")
 EMAIL_PORT = int(os.getenv("EMAIL_PORT", 587))
@@ -50,13 +76,124 @@ IMAGE_PATH = os.getenv("IMAGE_PATH", "image/maria_de_nazare.png")
 START_HOUR = int(os.getenv("START_HOUR", 8))
 END_HOUR = int(os.getenv("END_HOUR", 17))
 APPOINTMENT_DURATION_MINUTES = int(os.getenv("APPOINTMENT_DURATION_MINUTES", 60))
+# Expediente por dia da semana (ex.: "seg-sex=08:00-18:00;sab=08:00-12:00"), intervalos ("12:00-13:00")
+# e feriados ("2024-11-20,12-25"); sem BUSINESS_HOURS, todos os dias das START_HOUR às END_HOUR
+BUSINESS_HOURS = os.getenv("BUSINESS_HOURS", "")
+SCHEDULE_BREAKS = os.getenv("SCHEDULE_BREAKS", "")
+HOLIDAYS = os.getenv("HOLIDAYS", "")
+NEXT_SLOTS_COUNT = int(os.getenv("NEXT_SLOTS_COUNT", 6))
+NEXT_SLOTS_HORIZON_DAYS = int(os.getenv("NEXT_SLOTS_HORIZON_DAYS", 60))
+# Reserva temporária do horário enquanto o usuário digita o e-mail (renovada até SLOT_LEASE_MAX_HOLD)
+SLOT_LEASE_TTL = int(os.getenv("SLOT_LEASE_TTL", 300))
+SLOT_LEASE_RENEW_INTERVAL = int(os.getenv("SLOT_LEASE_RENEW_INTERVAL", 60))
+SLOT_LEASE_MAX_HOLD = int(os.getenv("SLOT_LEASE_MAX_HOLD", 900))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 20))
+# Agendamento em grupo (vagas no mesmo horário) e recorrente (mesmo horário por N semanas)
+GROUP_MAX_SEATS = int(os.getenv("GROUP_MAX_SEATS", 4))
+RECURRING_WEEK_OPTIONS = [int(weeks) for weeks in os.getenv("RECURRING_WEEK_OPTIONS", "1,2,4,8").split(",") if weeks.strip()]
+# Lista de espera: por quanto tempo a vaga liberada fica reservada para o inscrito avisado e quantos
+# avisos são enviados a cada execução do notificador
+WAITLIST_OFFER_TTL = int(os.getenv("WAITLIST_OFFER_TTL", 600))
+WAITLIST_NOTIFY_INTERVAL = int(os.getenv("WAITLIST_NOTIFY_INTERVAL", 5))
+WAITLIST_NOTIFY_RATE = int(os.getenv("WAITLIST_NOTIFY_RATE", 20))
+# Agendamento sem interação por este tempo é encerrado e a reserva do horário liberada
+SCHEDULING_INACTIVITY_TIMEOUT = int(os.getenv("SCHEDULING_INACTIVITY_TIMEOUT", 180))
 MAX_CONCURRENT_APPOINTMENTS = int(os.getenv("MAX_CONCURRENT_APPOINTMENTS", 1))
 MAX_APPOINTMENTS_PER_DAY = int(os.getenv("MAX_APPOINTMENTS_PER_DAY", 5))
+# Agendas dos atendentes (separadas por vírgula); quando definidas, a capacidade de cada horário
+# passa a ser o número de atendentes livres segundo o freebusy.query
+ATTENDANT_CALENDAR_IDS = [cal_id.strip() for cal_id in os.getenv("ATTENDANT_CALENDAR_IDS", "").split(",") if cal_id.strip()]
+CALENDAR_SYNC_INTERVAL_SECONDS = int(os.getenv("CALENDAR_SYNC_INTERVAL_SECONDS", 30))
+CALENDAR_SYNC_LOOKBACK_DAYS = int(os.getenv("CALENDAR_SYNC_LOOKBACK_DAYS", 31))
+CALENDAR_PAGE_SIZE = int(os.getenv("CALENDAR_PAGE_SIZE", 250))
+CALENDAR_EVENT_FIELDS = "nextPageToken,nextSyncToken,items(id,status,summary,description,start,end)"
+
+CALENDAR_WEBHOOK_URL = os.getenv("CALENDAR_WEBHOOK_URL")
+CALENDAR_WEBHOOK_PORT = int(os.getenv("CALENDAR_WEBHOOK_PORT", os.getenv("PORT", 8080)))
+CALENDAR_WEBHOOK_TOKEN = os.getenv("CALENDAR_WEBHOOK_TOKEN", "")
+CALENDAR_CHANNEL_TTL_SECONDS = int(os.getenv("CALENDAR_CHANNEL_TTL_SECONDS", 7 * 24 * 3600))
+EVENT_INDEX_DB = os.getenv("EVENT_INDEX_DB", "database/eventos.db")
+EVENT_INDEX_RECONCILE_INTERVAL = int(os.getenv("EVENT_INDEX_RECONCILE_INTERVAL", 3600))
+# Livro local de agendamentos: o agendamento é confirmado no SQLite e replicado depois no Google Calendar
+BOOKING_LEDGER_DB = os.getenv("BOOKING_LEDGER_DB", EVENT_INDEX_DB)
+BOOKING_SYNC_INTERVAL = int(os.getenv("BOOKING_SYNC_INTERVAL", 10))
+BOOKING_SYNC_BATCH = int(os.getenv("BOOKING_SYNC_BATCH", 20))
+BOOKING_SYNC_CLAIM_SECONDS = int(os.getenv("BOOKING_SYNC_CLAIM_SECONDS", 120))
+BOOKING_SYNC_MAX_BACKOFF = int(os.getenv("BOOKING_SYNC_MAX_BACKOFF", 3600))
+# Após este número de tentativas (ou um erro 4xx definitivo) o agendamento fica como 'falhou' e a equipe é avisada
+BOOKING_SYNC_MAX_ATTEMPTS = int(os.getenv("BOOKING_SYNC_MAX_ATTEMPTS", 10))
+BOOKING_ALERT_CHAT_ID = os.getenv("BOOKING_ALERT_CHAT_ID")
+AVAILABILITY_CACHE_TTL = int(os.getenv("AVAILABILITY_CACHE_TTL", 120))
+AVAILABILITY_TTL_TODAY = int(os.getenv("AVAILABILITY_TTL_TODAY", 30))
+AVAILABILITY_TTL_MONTH = int(os.getenv("AVAILABILITY_TTL_MONTH", 600))
+AVAILABILITY_TTL_FAR = int(os.getenv("AVAILABILITY_TTL_FAR", 3 * 3600))
+AVAILABILITY_TTL_MIN = int(os.getenv("AVAILABILITY_TTL_MIN", 10))
+AVAILABILITY_CHANGE_WINDOW = int(os.getenv("AVAILABILITY_CHANGE_WINDOW", 3600))
+AVAILABILITY_PUSH_TTL = int(os.getenv("AVAILABILITY_PUSH_TTL", 6 * 3600))
+AVAILABILITY_MAX_TTL = max(AVAILABILITY_CACHE_TTL, AVAILABILITY_TTL_MONTH, AVAILABILITY_TTL_FAR, AVAILABILITY_PUSH_TTL)
+AVAILABILITY_STATS_INTERVAL = int(os.getenv("AVAILABILITY_STATS_INTERVAL", 900))
+AVAILABILITY_PREWARM_MONTHS = int(os.getenv("AVAILABILITY_PREWARM_MONTHS", 2))
+AVAILABILITY_PREWARM_INTERVAL = int(os.getenv("AVAILABILITY_PREWARM_INTERVAL", 90))
+AVAILABILITY_PREWARM_MAX_INTERVAL = int(os.getenv("AVAILABILITY_PREWARM_MAX_INTERVAL", 1800))
+AVAILABILITY_PREWARM_SLOW_SECONDS = float(os.getenv("AVAILABILITY_PREWARM_SLOW_SECONDS", 5))
 
 # Cache e Redis
-busy_info_cache = TTLCache(maxsize=100, ttl=120)  # Cache com TTL de 2 minutos
+class AvailabilityCache(TTLCache):
+    """TTLCache que contabiliza acertos, faltas, remoções por tamanho e expirações."""
+
+    def __init__(self, maxsize, ttl, timer=time.monotonic):
+        super().__init__(maxsize=maxsize, ttl=ttl, timer=timer)
+        self.stats = {"hits": 0, "stale_hits": 0, "misses": 0, "shared_hits": 0, "evictions": 0, "expirations": 0}
+
+    def popitem(self):
+        item = super().popitem()
+        self.stats["evictions"] += 1
+        return item
+
+    def expire(self, time=None):
+        # Em cachetools 5.3.x expire() não retorna os itens removidos; conta pela diferença de tamanho.
+        # Cache.__len__ evita o len() do TTLCache, que chamaria expire() de novo.
+        size_before = Cache.__len__(self)
+        expired = super().expire(time)
+        self.stats["expirations"] += size_before - Cache.__len__(self)
+        return expired
+
+# Disponibilidade por dia; o TTL efetivo de cada dia é verificado na leitura (ver availability_cache_ttl)
+busy_info_cache = AvailabilityCache(maxsize=400, ttl=AVAILABILITY_MAX_TTL)
 cache_lock = threading.Lock()
+# Momentos das últimas alterações observadas por dia, usados para encurtar o TTL de dias movimentados
+availability_changes = {}
 redis_client = redis.Redis(host='localhost', port=6379, db=0)
+# Cliente assíncrono (pool compartilhado) para as reservas de horário, usado direto no event loop
+async_redis_client = aioredis.Redis(connection_pool=aioredis.ConnectionPool(
+    host='localhost', port=6379, db=0, max_connections=REDIS_MAX_CONNECTIONS
+))
+# Identificador deste processo nas mensagens de invalidação (pub/sub) entre workers
+WORKER_ID = uuid.uuid4().hex
+AVAILABILITY_INVALIDATION_CHANNEL = "availability:invalidate"
+SLOT_FREED_CHANNEL = "slots:freed"
+
+# Espelho local dos eventos do Google Calendar (sincronização incremental via syncToken)
+calendar_mirror = {"events": {}, "by_date": {}, "sync_token": None, "last_sync": None}
+mirror_lock = threading.RLock()
+# Serializa as sincronizações; a paginação no Google roda fora do mirror_lock para não travar os leitores
+mirror_sync_lock = threading.Lock()
+
+# Carregamentos de disponibilidade em andamento (single-flight), por intervalo de datas
+inflight_loads = {}
+inflight_lock = threading.Lock()
+inflight_async_loads = {}
+
+# Vagas liberadas (cancelamentos e reservas encerradas) aguardando o notificador da lista de espera: {(data, horário)}
+freed_slots = set()
+freed_lock = threading.Lock()
+
+# Canal de notificações push (events.watch) do Google Calendar. Há um único canal para todos os workers:
+# quem obtém a trava PUSH_CHANNEL_LEADER_KEY o registra e grava em PUSH_CHANNEL_KEY; os demais só o leem.
+push_channel = {"id": None, "resource_id": None, "expiration": None}
+push_channel_lock = threading.Lock()
+PUSH_CHANNEL_KEY = "calendar:push:channel"
+PUSH_CHANNEL_LEADER_KEY = "calendar:push:leader"
 
 # Mapeamento dos textos dos botões do menu principal para as tags das categorias
 MAIN_MENU_CATEGORIES = {
@@ -73,6 +210,8 @@ MAIN_MENU_CATEGORIES = {
     "🚪 Sair": "sair",
 }
 
+STALE_AVAILABILITY_HINT = "\n\n⚠️ _A disponibilidade pode estar desatualizada; o horário será confirmado ao agendar._"
+
 FEEDBACK_LEVELS = {
     "muito_insatisfeito": {"emoji": "💔", "value": 1},
     "insatisfeito": {"emoji": "😥", "value": 2},
@@ -110,14 +249,36 @@ def initialize_embeddings():
         logger.warning("Categoria 'paz_interior' não encontrada ou sem perguntas válidas")
 
 # --- INICIALIZAÇÃO DO GOOGLE CALENDAR ---
+# Credenciais carregadas uma única vez e compartilhadas; cada thread tem seu próprio
+# cliente (httplib2 não é thread-safe), reaproveitando a conexão keep-alive.
+calendar_credentials = None
+credentials_lock = threading.Lock()
+calendar_local = threading.local()
+
+def get_calendar_credentials():
+    global calendar_credentials
+    with credentials_lock:
+        if calendar_credentials is None:
+            calendar_credentials = service_account.Credentials.from_service_account_file(
+                SERVICE_ACCOUNT_FILE,
+                scopes=CALENDAR_SCOPES,
+            )
+        expiry = calendar_credentials.expiry
+        refresh_margin = timedelta(seconds=CALENDAR_TOKEN_REFRESH_MARGIN_SECONDS)
+        if not calendar_credentials.valid or (expiry and expiry - datetime.utcnow() < refresh_margin):
+            calendar_credentials.refresh(AuthorizedRequest(httplib2.Http(timeout=CALENDAR_HTTP_TIMEOUT)))
+            logger.debug(f"Token do Google Calendar renovado (expira em {calendar_credentials.expiry})")
+        return calendar_credentials
+
 def get_calendar_service():
     try:
-        credentials = service_account.Credentials.from_service_account_file(
-            SERVICE_ACCOUNT_FILE,
-            scopes=["https://www.googleapis.com/auth/calendar"],
-        )
-        service = build("calendar", "v3", credentials=credentials, cache_discovery=False)
-        logger.info("Serviço do Google Calendar inicializado com sucesso")
+        credentials = get_calendar_credentials()
+        service = getattr(calendar_local, "service", None)
+        if service is None:
+            http = AuthorizedHttp(credentials, http=httplib2.Http(timeout=CALENDAR_HTTP_TIMEOUT))
+            service = build("calendar", "v3", http=http, cache_discovery=False)
+            calendar_local.service = service
+            logger.info(f"Serviço do Google Calendar inicializado para a thread {threading.current_thread().name}")
         return service
     except FileNotFoundError:
         logger.error(f"Arquivo de conta de serviço não encontrado: {SERVICE_ACCOUNT_FILE}")
@@ -126,6 +287,1030 @@ def get_calendar_service():
         logger.error(f"Erro ao inicializar serviço do Google Calendar: {e}")
         return None
 
+# --- GATEWAY ASSÍNCRONO DO GOOGLE CALENDAR ---
+# Toda chamada bloqueante ao Calendar roda neste executor limitado, para que uma resposta
+# lenta do Google não congele o event loop do bot para os demais usuários.
+calendar_executor = ThreadPoolExecutor(max_workers=CALENDAR_MAX_WORKERS, thread_name_prefix="calendar")
+calendar_semaphore = None
+
+def get_calendar_semaphore():
+    global calendar_semaphore
+    if calendar_semaphore is None:
+        # Nunca mais vagas que threads: quem tem a vaga começa a rodar na hora, sem fila no executor
+        calendar_semaphore = asyncio.Semaphore(min(CALENDAR_MAX_CONCURRENCY, CALENDAR_MAX_WORKERS))
+    return calendar_semaphore
+
+# Circuit breaker: após CALENDAR_BREAKER_THRESHOLD falhas seguidas (timeout, 5xx, 429, rede),
+# as chamadas falham imediatamente por CALENDAR_BREAKER_COOLDOWN segundos; depois, uma chamada de teste.
+class CalendarUnavailableError(Exception):
+    pass
+
+calendar_breaker = {"failures": 0, "opened_at": None, "trial_in_progress": False}
+breaker_lock = threading.Lock()
+
+def is_calendar_outage(error):
+    if isinstance(error, HttpError):
+        return error.resp.status >= 500 or error.resp.status == 429
+    return isinstance(error, (asyncio.TimeoutError, TimeoutError, OSError, httplib2.HttpLib2Error))
+
+def calendar_circuit_open():
+    with breaker_lock:
+        opened_at = calendar_breaker["opened_at"]
+        return opened_at is not None and time.monotonic() - opened_at < CALENDAR_BREAKER_COOLDOWN
+
+def calendar_circuit_allows():
+    with breaker_lock:
+        opened_at = calendar_breaker["opened_at"]
+        if opened_at is None:
+            return True
+        if time.monotonic() - opened_at < CALENDAR_BREAKER_COOLDOWN or calendar_breaker["trial_in_progress"]:
+            return False
+        calendar_breaker["trial_in_progress"] = True
+        return True
+
+def record_calendar_result(error=None):
+    with breaker_lock:
+        calendar_breaker["trial_in_progress"] = False
+        if error is not None and not is_calendar_outage(error):
+            # Erro do cliente (404, 409...) não diz nada sobre a saúde do Google: mantém o estado do circuito
+            return
+        if error is None:
+            if calendar_breaker["opened_at"] is not None:
+                logger.info("Circuito do Google Calendar fechado")
+            calendar_breaker.update({"failures": 0, "opened_at": None})
+            return
+        calendar_breaker["failures"] += 1
+        if calendar_breaker["failures"] >= CALENDAR_BREAKER_THRESHOLD:
+            if calendar_breaker["opened_at"] is None:
+                logger.error(f"Circuito do Google Calendar aberto após {calendar_breaker['failures']} falhas")
+            calendar_breaker["opened_at"] = time.monotonic()
+
+def release_calendar_slot(loop, semaphore):
+    try:
+        loop.call_soon_threadsafe(semaphore.release)
+    except RuntimeError:
+        pass  # event loop já encerrado
+
+async def run_calendar(func, *args, timeout=CALENDAR_CALL_TIMEOUT, **kwargs):
+    """Executa func no executor do Calendar com limite de tempo e circuit breaker.
+
+    O tempo limite só começa a contar quando a chamada já está rodando numa thread: a espera por uma vaga
+    local não é falha do Google e não conta para o circuit breaker. O tempo esgotado não interrompe a
+    thread: a chamada pode ainda ser concluída no Google. Quem faz escritas não idempotentes deve
+    reconsultar o estado após asyncio.TimeoutError.
+    """
+    if not calendar_circuit_allows():
+        raise CalendarUnavailableError(f"Google Calendar indisponível (circuito aberto): {func.__name__}")
+    loop = asyncio.get_running_loop()
+    semaphore = get_calendar_semaphore()
+    await semaphore.acquire()
+    try:
+        future = calendar_executor.submit(functools.partial(func, *args, **kwargs))
+    except BaseException:
+        semaphore.release()
+        raise
+    # A vaga só volta ao semáforo quando a thread termina, mesmo que o chamador já tenha desistido
+    future.add_done_callback(lambda _: release_calendar_slot(loop, semaphore))
+    try:
+        result = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+    except asyncio.TimeoutError as e:
+        logger.error(f"Tempo esgotado ({timeout}s) na chamada ao Google Calendar: {func.__name__}")
+        record_calendar_result(e)
+        raise
+    except Exception as e:
+        record_calendar_result(e)
+        raise
+    record_calendar_result()
+    return result
+
+def require_calendar_service():
+    service = get_calendar_service()
+    if not service:
+        raise Exception("Serviço do Google Calendar não disponível")
+    return service
+
+def calendar_insert_event(event):
+    service = require_calendar_service()
+    try:
+        created_event = service.events().insert(calendarId=CALENDAR_ID, body=event).execute()
+    except HttpError as e:
+        # Com id determinístico, 409 significa que uma tentativa anterior já criou o evento
+        if e.resp.status != 409 or "id" not in event:
+            raise
+        created_event = service.events().get(calendarId=CALENDAR_ID, eventId=event["id"]).execute()
+        logger.info(f"Evento {event['id']} já existia no Google Calendar; inserção tratada como concluída")
+        invalidate_availability(apply_event_to_mirror(created_event))
+        update_event_index([created_event])
+        return created_event
+    apply_event_to_mirror(created_event)
+    update_event_index([created_event])
+    write_through_availability(created_event, 1)
+    return created_event
+
+def calendar_get_event(event_id):
+    return require_calendar_service().events().get(calendarId=CALENDAR_ID, eventId=event_id).execute()
+
+def calendar_event_deleted(event_id):
+    try:
+        return calendar_get_event(event_id).get("status") == "cancelled"
+    except HttpError as e:
+        if e.resp.status in (404, 410):
+            return True
+        raise
+
+def calendar_delete_event(event_id, event=None):
+    try:
+        require_calendar_service().events().delete(calendarId=CALENDAR_ID, eventId=event_id).execute()
+    except HttpError as e:
+        # Agendamento ainda não replicado no Google: basta cancelá-lo no livro local
+        if e.resp.status not in (404, 410) or not cancel_unreplicated_booking(event_id):
+            raise
+    cancel_ledger_bookings([event_id])
+    with mirror_lock:
+        event = event or calendar_mirror["events"].get(event_id)
+    apply_event_to_mirror({"id": event_id, "status": "cancelled"})
+    update_event_index([{"id": event_id, "status": "cancelled"}])
+    if event:
+        write_through_availability(event, -1)
+
+# --- OPERAÇÕES EM LOTE NO GOOGLE CALENDAR ---
+def calendar_batch_execute(build_requests):
+    service = require_calendar_service()
+    return executar_em_lote(service, build_requests(service), CALENDAR_BATCH_SIZE)
+
+def calendar_batch_get(event_ids):
+    """Busca eventos em lote; retorna {id: (evento, erro)}."""
+    return calendar_batch_execute(lambda service: [
+        (event_id, service.events().get(calendarId=CALENDAR_ID, eventId=event_id)) for event_id in event_ids
+    ])
+
+def calendar_batch_insert(events):
+    """Insere eventos (com id definido) em lote; retorna (criados por id, falhas por id)."""
+    results = calendar_batch_execute(lambda service: [
+        (event["id"], service.events().insert(calendarId=CALENDAR_ID, body=event)) for event in events
+    ])
+    created, failures, conflicts = {}, {}, []
+    for event in events:
+        response, exception = results[event["id"]]
+        if exception is None:
+            apply_event_to_mirror(response)
+            write_through_availability(response, 1)
+            created[event["id"]] = response
+        elif isinstance(exception, HttpError) and exception.resp.status == 409:
+            # Já criado numa tentativa anterior (id determinístico); o espelho recebe a versão do Google
+            conflicts.append(event["id"])
+        else:
+            failures[event["id"]] = exception
+            logger.error(f"Erro ao inserir evento {event['id']} em lote: {exception}")
+    if conflicts:
+        existing = calendar_batch_get(conflicts)
+        for event_id in conflicts:
+            response, exception = existing[event_id]
+            if exception is not None:
+                failures[event_id] = exception
+                logger.error(f"Erro ao buscar evento {event_id} já existente: {exception}")
+                continue
+            logger.info(f"Evento {event_id} já existia no Google Calendar; inserção tratada como concluída")
+            invalidate_availability(apply_event_to_mirror(response))
+            created[event_id] = response
+    update_event_index(list(created.values()))
+    logger.info(f"Inserção em lote: {len(created)} de {len(events)} eventos criados")
+    return created, failures
+
+# --- ESPELHO LOCAL DO GOOGLE CALENDAR ---
+def describe_event(event):
+    start_time = get_event_start(event)
+    if not start_time:
+        return f"Evento ID: {event['id']} (Detalhes de data/hora não disponíveis)"
+    return f"{start_time.strftime('%d/%m/%Y %H:%M')} - {event.get('summary', 'Evento sem título')}"
+
+def get_event_start(event):
+    start = event.get("start", {}).get("dateTime")
+    if not start:
+        return None
+    try:
+        return datetime.fromisoformat(start.replace("Z", "+00:00")).astimezone()
+    except ValueError:
+        logger.warning(f"Formato de data/hora inválido em evento: {start}")
+        return None
+
+def iter_calendar_events(service, page_state, page_size=CALENDAR_PAGE_SIZE, fields=CALENDAR_EVENT_FIELDS, **params):
+    page_token = None
+    while True:
+        result = service.events().list(
+            calendarId=CALENDAR_ID,
+            pageToken=page_token,
+            maxResults=page_size,
+            fields=fields,
+            **params
+        ).execute()
+        page_state["pages"] = page_state.get("pages", 0) + 1
+        yield from result.get("items", [])
+        page_token = result.get("nextPageToken")
+        if not page_token:
+            page_state["next_sync_token"] = result.get("nextSyncToken")
+            return
+
+def apply_event_stream(events):
+    changed_dates = set()
+    pending_index = []
+    cancelled_ids = []
+    count = 0
+    for event in events:
+        changed_dates.update(apply_event_to_mirror(event))
+        count += 1
+        if event.get("status") == "cancelled":
+            cancelled_ids.append(event["id"])
+        pending_index.append(event)
+        if len(pending_index) >= CALENDAR_PAGE_SIZE:
+            update_event_index(pending_index)
+            pending_index = []
+    update_event_index(pending_index)
+    # Eventos removidos direto no Google liberam a vaga correspondente no livro local
+    cancel_ledger_bookings(cancelled_ids)
+    return changed_dates, count
+
+def remove_event_from_mirror(event_id):
+    old_event = calendar_mirror["events"].pop(event_id, None)
+    if not old_event:
+        return None
+    old_start = get_event_start(old_event)
+    if old_start:
+        day_ids = calendar_mirror["by_date"].get(old_start.date())
+        if day_ids:
+            day_ids.discard(event_id)
+        return old_start.date()
+    return None
+
+def apply_event_to_mirror(event):
+    changed_dates = set()
+    with mirror_lock:
+        old_date = remove_event_from_mirror(event["id"])
+        if old_date:
+            changed_dates.add(old_date)
+        if event.get("status") == "cancelled":
+            return changed_dates
+        calendar_mirror["events"][event["id"]] = event
+        event_start = get_event_start(event)
+        if event_start:
+            calendar_mirror["by_date"].setdefault(event_start.date(), set()).add(event["id"])
+            changed_dates.add(event_start.date())
+    return changed_dates
+
+def event_fingerprint(event):
+    # Só o que afeta a disponibilidade: horário de início/fim e status
+    start, end = event.get("start", {}), event.get("end", {})
+    return (
+        event["id"], start.get("dateTime") or start.get("date"), end.get("dateTime") or end.get("date"), event.get("status")
+    )
+
+def mirror_fingerprint():
+    # Chamada com mirror_lock adquirido
+    return {
+        day_date: {event_fingerprint(calendar_mirror["events"][event_id]) for event_id in event_ids}
+        for day_date, event_ids in calendar_mirror["by_date"].items()
+    }
+
+def mirror_is_fresh():
+    with mirror_lock:
+        last_sync = calendar_mirror["last_sync"]
+    sync_interval = AVAILABILITY_PUSH_TTL if push_channel_active() else CALENDAR_SYNC_INTERVAL_SECONDS
+    return bool(last_sync) and time.monotonic() - last_sync < sync_interval
+
+def sync_calendar_mirror(force=False, full=False):
+    if not force and not full and mirror_is_fresh():
+        return set()
+    with mirror_sync_lock:
+        # Outra thread pode ter sincronizado enquanto esta esperava
+        if not force and not full and mirror_is_fresh():
+            return set()
+        try:
+            return fetch_calendar_mirror(require_calendar_service(), full)
+        except Exception:
+            # Sem isso a próxima chamada confiaria num espelho que não foi atualizado
+            with mirror_lock:
+                calendar_mirror["last_sync"] = None
+            raise
+
+def fetch_calendar_mirror(service, full):
+    with mirror_lock:
+        sync_token = None if full else calendar_mirror["sync_token"]
+    if sync_token:
+        page_state = {}
+        try:
+            events = list(iter_calendar_events(service, page_state, singleEvents=True, syncToken=sync_token))
+        except HttpError as e:
+            if e.resp.status != 410:
+                raise
+            logger.warning("syncToken expirado, refazendo sincronização completa do calendário")
+        else:
+            # Todas as páginas chegaram: só agora o espelho é alterado
+            changed_dates, count = apply_event_stream(events)
+            with mirror_lock:
+                calendar_mirror.update({"sync_token": page_state["next_sync_token"], "last_sync": time.monotonic()})
+            logger.debug(f"Sincronização incremental do calendário: {count} alterações em {page_state['pages']} página(s)")
+            return changed_dates
+    time_min = (datetime.utcnow() - timedelta(days=CALENDAR_SYNC_LOOKBACK_DAYS)).isoformat() + "Z"
+    page_state = {}
+    events = list(iter_calendar_events(service, page_state, singleEvents=True, timeMin=time_min))
+    # O novo espelho é montado à parte e trocado de uma vez; uma falha no meio mantém o anterior
+    new_events, new_by_date, cancelled_ids = {}, {}, []
+    for event in events:
+        if event.get("status") == "cancelled":
+            cancelled_ids.append(event["id"])
+            continue
+        new_events[event["id"]] = event
+        event_start = get_event_start(event)
+        if event_start:
+            new_by_date.setdefault(event_start.date(), set()).add(event["id"])
+    with mirror_lock:
+        previous = mirror_fingerprint()
+        calendar_mirror.update({
+            "events": new_events,
+            "by_date": new_by_date,
+            "sync_token": page_state["next_sync_token"],
+            "last_sync": time.monotonic(),
+        })
+        current = mirror_fingerprint()
+    # Só as datas cujos eventos mudaram (entraram, saíram ou mudaram de horário) são invalidadas e publicadas
+    changed_dates = {
+        day_date for day_date in previous.keys() | current.keys()
+        if previous.get(day_date, set()) != current.get(day_date, set())
+    }
+    cancel_ledger_bookings(cancelled_ids)
+    rebuild_event_index(list(new_events.values()), time_min)
+    logger.info(f"Sincronização completa do calendário: {len(events)} eventos em {page_state['pages']} página(s)")
+    return changed_dates
+
+def get_mirror_events(start_date, end_date):
+    events = []
+    with mirror_lock:
+        current_date = start_date
+        while current_date < end_date:
+            for event_id in calendar_mirror["by_date"].get(current_date, ()):
+                events.append(calendar_mirror["events"][event_id])
+            current_date += timedelta(days=1)
+    return events
+
+# --- ÍNDICE LOCAL E-MAIL → EVENTO (SQLITE) ---
+EMAIL_IN_TEXT_PATTERN = re.compile(r'[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+')
+
+def init_event_index():
+    index_dir = os.path.dirname(EVENT_INDEX_DB)
+    if index_dir:
+        os.makedirs(index_dir, exist_ok=True)
+    conn = sqlite3.connect(EVENT_INDEX_DB)
+    try:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS event_index (
+                event_id TEXT NOT NULL,
+                email TEXT NOT NULL,
+                start_time TEXT NOT NULL,
+                summary TEXT,
+                PRIMARY KEY (event_id, email)
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_event_index_email_start ON event_index (email, start_time)")
+        conn.commit()
+    finally:
+        conn.close()
+    logger.info(f"Índice de eventos inicializado em {EVENT_INDEX_DB}")
+
+def event_index_rows(event):
+    event_start = get_event_start(event)
+    if event.get("status") == "cancelled" or not event_start:
+        return []
+    start_utc = event_start.astimezone(timezone.utc).isoformat()
+    emails = {email.lower().rstrip(".") for email in EMAIL_IN_TEXT_PATTERN.findall(event.get("description", ""))}
+    return [(event["id"], email, start_utc, event.get("summary")) for email in emails]
+
+def update_event_index(events):
+    if not events:
+        return
+    conn = sqlite3.connect(EVENT_INDEX_DB, timeout=10)
+    try:
+        with conn:
+            conn.executemany("DELETE FROM event_index WHERE event_id = ?", [(event["id"],) for event in events])
+            conn.executemany(
+                "INSERT OR REPLACE INTO event_index (event_id, email, start_time, summary) VALUES (?, ?, ?, ?)",
+                [row for event in events for row in event_index_rows(event)]
+            )
+    finally:
+        conn.close()
+
+def rebuild_event_index(events, time_min):
+    # Agendamentos do livro ainda não replicados não estão no Google, mas precisam continuar listáveis
+    known_ids = {event["id"] for event in events}
+    events = events + [event for event in unsynced_booking_events() if event["id"] not in known_ids]
+    conn = sqlite3.connect(EVENT_INDEX_DB, timeout=10)
+    try:
+        with conn:
+            conn.execute("DELETE FROM event_index WHERE start_time >= ?", (time_min.replace("Z", "+00:00"),))
+            conn.executemany(
+                "INSERT OR REPLACE INTO event_index (event_id, email, start_time, summary) VALUES (?, ?, ?, ?)",
+                [row for event in events for row in event_index_rows(event)]
+            )
+    finally:
+        conn.close()
+    logger.info(f"Índice de eventos reconciliado com o Google Calendar ({len(events)} eventos)")
+
+def query_event_index(email, time_min, time_max, page, page_size):
+    conn = sqlite3.connect(EVENT_INDEX_DB, timeout=10)
+    try:
+        filters = "email = ? AND start_time >= ?" + (" AND start_time < ?" if time_max else "")
+        params = (email, time_min) + ((time_max,) if time_max else ())
+        total = conn.execute(f"SELECT COUNT(*) FROM event_index WHERE {filters}", params).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT event_id, start_time, summary FROM event_index WHERE {filters} ORDER BY start_time LIMIT ? OFFSET ?",
+            params + (page_size, page * page_size)
+        ).fetchall()
+    finally:
+        conn.close()
+    events = [{"id": event_id, "start": {"dateTime": start_time}, "summary": summary} for event_id, start_time, summary in rows]
+    return events, total
+
+async def reconcile_event_index(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        invalidate_availability(await run_calendar(sync_calendar_mirror, full=True))
+    except Exception as e:
+        logger.error(f"Erro ao reconciliar índice de eventos: {str(e)}\n{traceback.format_exc()}")
+
+# --- LIVRO DE AGENDAMENTOS (SQLITE) ---
+# O agendamento é confirmado aqui, numa transação; sync_pending_bookings replica no Google em segundo plano.
+# O índice único parcial garante no banco que cada vaga (data, horário, vaga) tenha um único agendamento ativo.
+def init_booking_ledger():
+    ledger_dir = os.path.dirname(BOOKING_LEDGER_DB)
+    if ledger_dir:
+        os.makedirs(ledger_dir, exist_ok=True)
+    conn = sqlite3.connect(BOOKING_LEDGER_DB)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS agendamentos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                nome TEXT NOT NULL,
+                telefone TEXT NOT NULL,
+                email TEXT NOT NULL,
+                data TEXT NOT NULL,
+                horario TEXT NOT NULL,
+                vaga INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pendente',
+                event_id TEXT,
+                tentativas INTEGER NOT NULL DEFAULT 0,
+                proxima_tentativa REAL NOT NULL DEFAULT 0,
+                ultimo_erro TEXT,
+                criado_em TEXT NOT NULL,
+                idempotency_key TEXT
+            )
+        """)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(agendamentos)")}
+        if "idempotency_key" not in columns:
+            conn.execute("ALTER TABLE agendamentos ADD COLUMN idempotency_key TEXT")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_agendamentos_idempotencia ON agendamentos (idempotency_key)")
+        conn.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_agendamentos_vaga
+            ON agendamentos (data, horario, vaga) WHERE status != 'cancelado'
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_agendamentos_pendentes
+            ON agendamentos (proxima_tentativa) WHERE status = 'pendente'
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_agendamentos_nao_sincronizados
+            ON agendamentos (data) WHERE status IN ('pendente', 'falhou')
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS lista_espera (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                nome TEXT NOT NULL,
+                telefone TEXT NOT NULL,
+                data TEXT NOT NULL,
+                horario TEXT,
+                status TEXT NOT NULL DEFAULT 'aguardando',
+                criado_em TEXT NOT NULL,
+                oferecido_em TEXT,
+                horario_oferecido TEXT
+            )
+        """)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(lista_espera)")}
+        if "horario_oferecido" not in columns:
+            conn.execute("ALTER TABLE lista_espera ADD COLUMN horario_oferecido TEXT")
+        conn.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_lista_espera_inscricao
+            ON lista_espera (user_id, data, IFNULL(horario, '')) WHERE status = 'aguardando'
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_lista_espera_fila
+            ON lista_espera (data, id) WHERE status = 'aguardando'
+        """)
+        # Linhas antigas sem event_id recebem um id determinístico, usado no índice, no cancelamento e no Google
+        conn.executemany("UPDATE agendamentos SET event_id = ? WHERE id = ?", [
+            (idempotency_key or booking_idempotency_key("ledger", datetime.strptime(data, "%Y-%m-%d").date(), horario, booking_id), booking_id)
+            for booking_id, data, horario, idempotency_key in conn.execute(
+                "SELECT id, data, horario, idempotency_key FROM agendamentos WHERE event_id IS NULL"
+            ).fetchall()
+        ])
+        conn.commit()
+        pending = conn.execute("SELECT COUNT(*) FROM agendamentos WHERE status = 'pendente'").fetchone()[0]
+    finally:
+        conn.close()
+    logger.info(f"Livro de agendamentos inicializado em {BOOKING_LEDGER_DB} ({pending} pendente(s) de sincronização)")
+
+def load_unsynced_bookings(start_date, end_date):
+    """Agendamentos do livro ainda não replicados no Google: {data: {índice do horário: quantidade}}.
+
+    Lido do banco compartilhado (e não de memória) para que todos os workers vejam os agendamentos uns dos outros.
+    """
+    conn = sqlite3.connect(BOOKING_LEDGER_DB, timeout=10)
+    try:
+        rows = conn.execute(
+            "SELECT data, horario, COUNT(*) FROM agendamentos WHERE status IN ('pendente', 'falhou') AND data >= ? AND data < ? "
+            "GROUP BY data, horario",
+            (start_date.isoformat(), end_date.isoformat())
+        ).fetchall()
+    finally:
+        conn.close()
+    unsynced = {}
+    for data, horario, count in rows:
+        slot_index = SLOT_INDEX.get(horario)
+        if slot_index is not None:
+            unsynced.setdefault(datetime.strptime(data, "%Y-%m-%d").date(), {})[slot_index] = count
+    return unsynced
+
+def overlay_pending_bookings(entry, day_pending):
+    if not day_pending:
+        return entry["slots"], entry["total"]
+    slots = array("H", entry["slots"])
+    for slot_index, count in day_pending.items():
+        slots[slot_index] += count
+    return slots, entry["total"] + sum(day_pending.values())
+
+def booking_idempotency_key(user_id, day_date, slot_str, attempt):
+    # Hexadecimal é um subconjunto do base32hex aceito como id de evento pelo Google Calendar
+    return hashlib.sha256(f"{user_id}|{day_date.isoformat()}|{slot_str}|{attempt}".encode()).hexdigest()[:32]
+
+def count_external_events(day_events, slot_str, ledger_event_ids):
+    """Eventos do espelho do Google no dia (total, no horário) que não vieram do livro local (ex.: criados pela equipe)."""
+    slot_index = SLOT_INDEX.get(slot_str)
+    day_total = slot_total = 0
+    for event in day_events:
+        event_start = get_event_start(event)
+        if event["id"] in ledger_event_ids or not event_start:
+            continue
+        day_total += 1
+        if get_slot_index(event_start.time()) == slot_index:
+            slot_total += 1
+    return day_total, slot_total
+
+def select_bookings_by_keys(conn, idempotency_keys):
+    placeholders = ", ".join("?" for _ in idempotency_keys)
+    return [row[0] for row in conn.execute(
+        f"SELECT id FROM agendamentos WHERE idempotency_key IN ({placeholders}) ORDER BY id", idempotency_keys
+    )]
+
+def find_bookings_by_keys(idempotency_keys):
+    conn = sqlite3.connect(BOOKING_LEDGER_DB, timeout=10)
+    try:
+        return select_bookings_by_keys(conn, idempotency_keys)
+    finally:
+        conn.close()
+
+def commit_bookings(nome, telefone, email, slot_str, occurrences, seats, idempotency_keys):
+    """Grava `seats` vagas do horário em cada data de `occurrences` ([(data, capacidade)]), tudo ou nada.
+
+    idempotency_keys traz uma chave por vaga, na ordem (data, vaga). Retorna (ids, criados); repetir as
+    mesmas chaves devolve os agendamentos já gravados com criados=False, e (None, False) indica falta de vaga.
+    A ocupação conta os agendamentos do livro, dentro da transação, e os eventos do espelho do Google criados
+    fora dele, lidos logo antes dela; eventos externos criados depois da última sincronização não são vistos.
+    """
+    # O espelho é lido antes do BEGIN IMMEDIATE: o mirror_lock nunca é esperado com o livro travado para escrita
+    mirror_events = {day_date: get_mirror_events(day_date, day_date + timedelta(days=1)) for day_date, _ in occurrences}
+    conn = sqlite3.connect(BOOKING_LEDGER_DB, timeout=10, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        existing = select_bookings_by_keys(conn, idempotency_keys)
+        if existing:
+            conn.execute("ROLLBACK")
+            return existing, False
+        rows = []
+        keys = iter(idempotency_keys)
+        for day_date, capacity in occurrences:
+            day_bookings = conn.execute(
+                "SELECT horario, vaga, event_id FROM agendamentos WHERE data = ? AND status != 'cancelado'",
+                (day_date.isoformat(),)
+            ).fetchall()
+            taken = {vaga for horario, vaga, _ in day_bookings if horario == slot_str}
+            external_day, external_slot = count_external_events(
+                mirror_events[day_date], slot_str, {event_id for _, _, event_id in day_bookings}
+            )
+            free_seats = [vaga for vaga in range(capacity) if vaga not in taken][:max(0, capacity - len(taken) - external_slot)][:seats]
+            if len(free_seats) < seats or len(day_bookings) + external_day + seats > MAX_APPOINTMENTS_PER_DAY:
+                conn.execute("ROLLBACK")
+                return None, False
+            for seat in free_seats:
+                key = next(keys)
+                rows.append((nome, telefone, email, day_date.isoformat(), slot_str, seat, key, key,
+                             datetime.now(timezone.utc).isoformat()))
+        booking_ids = [
+            conn.execute(
+                "INSERT INTO agendamentos (nome, telefone, email, data, horario, vaga, event_id, idempotency_key, criado_em) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", row
+            ).lastrowid
+            for row in rows
+        ]
+        conn.execute("COMMIT")
+    except sqlite3.IntegrityError:
+        conn.execute("ROLLBACK")
+        return None, False
+    finally:
+        conn.close()
+    # Já aparecem na listagem de cancelamento antes de chegarem ao Google
+    update_event_index([
+        build_appointment_event(nome, telefone, email, datetime.strptime(f"{row[3]} {row[4]}", "%Y-%m-%d %H:%M"), row[6])
+        for row in rows
+    ])
+    return booking_ids, True
+
+def unsynced_booking_events():
+    conn = sqlite3.connect(BOOKING_LEDGER_DB, timeout=10)
+    try:
+        rows = conn.execute(
+            "SELECT nome, telefone, email, data, horario, event_id FROM agendamentos WHERE status IN ('pendente', 'falhou')"
+        ).fetchall()
+    finally:
+        conn.close()
+    return [
+        build_appointment_event(nome, telefone, email, datetime.strptime(f"{data} {horario}", "%Y-%m-%d %H:%M"), event_id)
+        for nome, telefone, email, data, horario, event_id in rows
+    ]
+
+def mark_booking_synced(booking_id, event_id):
+    """Marca como replicado; False se o agendamento foi cancelado enquanto a inserção estava em andamento."""
+    conn = sqlite3.connect(BOOKING_LEDGER_DB, timeout=10)
+    try:
+        with conn:
+            cursor = conn.execute(
+                "UPDATE agendamentos SET status = 'sincronizado', event_id = ?, ultimo_erro = NULL "
+                "WHERE id = ? AND status IN ('pendente', 'falhou')",
+                (event_id, booking_id)
+            )
+        return cursor.rowcount == 1
+    finally:
+        conn.close()
+
+def claim_pending_bookings(now):
+    conn = sqlite3.connect(BOOKING_LEDGER_DB, timeout=10, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute(
+            "SELECT id, nome, telefone, email, data, horario, tentativas, event_id FROM agendamentos "
+            "WHERE status = 'pendente' AND proxima_tentativa <= ? ORDER BY proxima_tentativa LIMIT ?",
+            (now, BOOKING_SYNC_BATCH)
+        ).fetchall()
+        conn.executemany(
+            "UPDATE agendamentos SET proxima_tentativa = ? WHERE id = ?",
+            [(now + BOOKING_SYNC_CLAIM_SECONDS, row[0]) for row in rows]
+        )
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return rows
+
+def update_booking(booking_id, **fields):
+    conn = sqlite3.connect(BOOKING_LEDGER_DB, timeout=10)
+    try:
+        with conn:
+            assignments = ", ".join(f"{column} = ?" for column in fields)
+            conn.execute(f"UPDATE agendamentos SET {assignments} WHERE id = ?", (*fields.values(), booking_id))
+    finally:
+        conn.close()
+
+def cancel_ledger_bookings(event_ids):
+    if not event_ids:
+        return
+    conn = sqlite3.connect(BOOKING_LEDGER_DB, timeout=10)
+    try:
+        with conn:
+            conn.executemany(
+                "UPDATE agendamentos SET status = 'cancelado' WHERE event_id = ? AND status != 'cancelado'",
+                [(event_id,) for event_id in event_ids]
+            )
+    finally:
+        conn.close()
+
+def cancel_unreplicated_booking(event_id):
+    """Cancela um agendamento que ainda não chegou ao Google; retorna a data dele ou None se não havia."""
+    conn = sqlite3.connect(BOOKING_LEDGER_DB, timeout=10)
+    try:
+        with conn:
+            row = conn.execute(
+                "SELECT data FROM agendamentos WHERE event_id = ? AND status IN ('pendente', 'falhou')", (event_id,)
+            ).fetchone()
+            if row:
+                conn.execute(
+                    "UPDATE agendamentos SET status = 'cancelado' WHERE event_id = ? AND status IN ('pendente', 'falhou')",
+                    (event_id,)
+                )
+    finally:
+        conn.close()
+    if not row:
+        return None
+    # A vaga vinha da sobreposição de pendentes no cache de disponibilidade
+    day_date = datetime.strptime(row[0], "%Y-%m-%d").date()
+    invalidate_availability([day_date])
+    logger.info(f"Agendamento {event_id} cancelado antes de chegar ao Google Calendar")
+    return day_date
+
+def add_waitlist_entry(user_id, chat_id, nome, telefone, day_date, slot_str=None):
+    """Inscreve o usuário na lista de espera do dia (slot_str=None) ou de um horário; False se já inscrito."""
+    conn = sqlite3.connect(BOOKING_LEDGER_DB, timeout=10)
+    try:
+        with conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO lista_espera (user_id, chat_id, nome, telefone, data, horario, criado_em) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (user_id, chat_id, nome, telefone, day_date.isoformat(), slot_str, datetime.now(timezone.utc).isoformat())
+            )
+        return cursor.rowcount == 1
+    finally:
+        conn.close()
+
+def claim_waitlist_entry(day_date, slot_str):
+    """Retira da fila o inscrito mais antigo do horário (ou do dia inteiro) e o marca como 'oferecido'.
+
+    Quem já recebeu uma oferta e voltou para a fila fica atrás de quem ainda não recebeu nenhuma. Retorna
+    também oferecido_em/horario_oferecido anteriores, restaurados por unclaim_waitlist_entry se a vaga escapar.
+    """
+    conn = sqlite3.connect(BOOKING_LEDGER_DB, timeout=10, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT id, user_id, chat_id, nome, telefone, oferecido_em, horario_oferecido FROM lista_espera "
+            "WHERE status = 'aguardando' AND data = ? AND (horario IS NULL OR horario = ?) "
+            "ORDER BY oferecido_em IS NOT NULL, oferecido_em, id LIMIT 1",
+            (day_date.isoformat(), slot_str)
+        ).fetchone()
+        if row:
+            conn.execute(
+                "UPDATE lista_espera SET status = 'oferecido', oferecido_em = ?, horario_oferecido = ? WHERE id = ?",
+                (datetime.now(timezone.utc).isoformat(), slot_str, row[0])
+            )
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return row
+
+def requeue_waitlist_rows(conn, entry_ids):
+    # Só inscrições com oferta em aberto voltam para a fila; se o usuário já se inscreveu de novo no
+    # mesmo dia/horário, o índice único impede a volta e esta inscrição é encerrada
+    for entry_id in entry_ids:
+        cursor = conn.execute(
+            "UPDATE OR IGNORE lista_espera SET status = 'aguardando' WHERE id = ? AND status IN ('oferecido', 'reservado')",
+            (entry_id,)
+        )
+        if cursor.rowcount == 0:
+            conn.execute(
+                "UPDATE lista_espera SET status = 'cancelado' WHERE id = ? AND status IN ('oferecido', 'reservado')",
+                (entry_id,)
+            )
+
+def unclaim_waitlist_entry(entry_id, offered_at, offered_slot):
+    """Desfaz claim_waitlist_entry quando a vaga não pôde ser reservada: a oferta nunca existiu."""
+    conn = sqlite3.connect(BOOKING_LEDGER_DB, timeout=10)
+    try:
+        with conn:
+            conn.execute(
+                "UPDATE lista_espera SET oferecido_em = ?, horario_oferecido = ? WHERE id = ? AND status = 'oferecido'",
+                (offered_at, offered_slot, entry_id)
+            )
+            requeue_waitlist_rows(conn, [entry_id])
+    finally:
+        conn.close()
+
+def requeue_waitlist_entry(entry_id):
+    conn = sqlite3.connect(BOOKING_LEDGER_DB, timeout=10)
+    try:
+        with conn:
+            requeue_waitlist_rows(conn, [entry_id])
+    finally:
+        conn.close()
+
+def release_stale_waitlist_offers(offered_before, reserved_before):
+    """Devolve à fila ofertas sem resposta ou reservas abandonadas (ex.: worker reiniciado); retorna (data, horário)."""
+    conn = sqlite3.connect(BOOKING_LEDGER_DB, timeout=10, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute(
+            "SELECT id, data, horario_oferecido FROM lista_espera "
+            "WHERE (status = 'oferecido' AND oferecido_em < ?) OR (status = 'reservado' AND oferecido_em < ?)",
+            (offered_before.isoformat(), reserved_before.isoformat())
+        ).fetchall()
+        requeue_waitlist_rows(conn, [row[0] for row in rows])
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return [(row[1], row[2]) for row in rows if row[2]]
+
+def update_waitlist_entry(entry_id, status):
+    conn = sqlite3.connect(BOOKING_LEDGER_DB, timeout=10)
+    try:
+        with conn:
+            conn.execute("UPDATE lista_espera SET status = ? WHERE id = ?", (status, entry_id))
+    finally:
+        conn.close()
+
+async def run_ledger(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+async def sync_pending_bookings(context: ContextTypes.DEFAULT_TYPE):
+    now = time.time()
+    try:
+        rows = await run_ledger(claim_pending_bookings, now)
+    except sqlite3.Error as e:
+        logger.error(f"Erro ao ler agendamentos pendentes: {str(e)}\n{traceback.format_exc()}")
+        return
+    if not rows:
+        return
+    bookings = {}
+    for booking_id, nome, telefone, email, data, horario, tentativas, event_id in rows:
+        start_time = datetime.strptime(f"{data} {horario}", "%Y-%m-%d %H:%M")
+        bookings[event_id] = (booking_id, start_time, tentativas, build_appointment_event(nome, telefone, email, start_time, event_id))
+    # Todos os pendentes (inclusive as ocorrências de um agendamento em grupo) vão numa única requisição em lote
+    try:
+        created, failures = await run_calendar(calendar_batch_insert, [booking[3] for booking in bookings.values()])
+    except Exception as e:
+        # Num tempo esgotado o lote pode ainda ser concluído; os ids são determinísticos, então a
+        # próxima tentativa recebe 409 e adota os eventos já criados em vez de duplicá-los
+        created, failures = {}, {event_id: e for event_id in bookings}
+    for event_id, (booking_id, start_time, tentativas, _) in bookings.items():
+        if event_id in created:
+            if await run_ledger(mark_booking_synced, booking_id, event_id):
+                logger.info(f"Agendamento {booking_id} replicado no Google Calendar")
+            else:
+                # Cancelado pelo usuário enquanto a inserção estava em andamento
+                logger.info(f"Agendamento {booking_id} cancelado durante a replicação; removendo do Google Calendar")
+                try:
+                    await run_calendar(calendar_delete_event, event_id)
+                except Exception as e:
+                    logger.error(f"Erro ao remover evento {event_id} de agendamento cancelado: {str(e)}\n{traceback.format_exc()}")
+            continue
+        error = failures.get(event_id)
+        if is_permanent_calendar_error(error) or tentativas + 1 >= BOOKING_SYNC_MAX_ATTEMPTS:
+            # A vaga continua ocupada no livro (o usuário já recebeu a confirmação); a equipe resolve manualmente
+            await run_ledger(update_booking, booking_id, status="falhou", tentativas=tentativas + 1, ultimo_erro=str(error))
+            logger.error(f"Agendamento {booking_id} não pôde ser replicado no Google após {tentativas + 1} tentativa(s): {error}")
+            await alert_booking_sync_failure(context, booking_id, start_time, error)
+            continue
+        delay = min(BOOKING_SYNC_MAX_BACKOFF, BOOKING_SYNC_INTERVAL * 2 ** tentativas)
+        await run_ledger(update_booking, booking_id, tentativas=tentativas + 1, ultimo_erro=str(error), proxima_tentativa=now + delay)
+        logger.warning(f"Falha ao replicar agendamento {booking_id} no Google (tentativa {tentativas + 1}), nova tentativa em {delay}s: {error}")
+
+def is_permanent_calendar_error(error):
+    # 403 pode ser limite de uso, 408/429 são transitórios e 409 já é tratado como sucesso
+    return isinstance(error, HttpError) and 400 <= error.resp.status < 500 and error.resp.status not in (403, 408, 409, 429)
+
+async def alert_booking_sync_failure(context: ContextTypes.DEFAULT_TYPE, booking_id, start_time, error):
+    if not BOOKING_ALERT_CHAT_ID:
+        return
+    try:
+        await context.bot.send_message(
+            chat_id=BOOKING_ALERT_CHAT_ID,
+            text=f"⚠️ Agendamento {booking_id} ({start_time.strftime('%d/%m/%Y %H:%M')}) confirmado ao usuário, "
+                 f"mas não foi criado no Google Calendar: {error}\nVerifique a tabela agendamentos (status 'falhou').",
+        )
+    except Exception as e:
+        logger.warning(f"Não foi possível enviar o alerta do agendamento {booking_id}: {e}")
+
+# --- NOTIFICAÇÕES PUSH DO GOOGLE CALENDAR ---
+def push_channel_active():
+    with push_channel_lock:
+        expiration = push_channel["expiration"]
+    return expiration is not None and expiration - time.time() > 60
+
+def stop_calendar_watch(channel_id, resource_id):
+    try:
+        require_calendar_service().channels().stop(body={"id": channel_id, "resourceId": resource_id}).execute()
+        logger.info(f"Canal push {channel_id} encerrado")
+    except Exception as e:
+        logger.warning(f"Erro ao encerrar canal push {channel_id}: {e}")
+
+def load_shared_push_channel():
+    """Atualiza push_channel com o canal registrado por qualquer worker; False se o Redis não respondeu."""
+    try:
+        raw = redis_client.get(PUSH_CHANNEL_KEY)
+    except redis.RedisError as e:
+        logger.warning(f"Não foi possível ler o canal push compartilhado: {e}")
+        return False
+    if raw:
+        with push_channel_lock:
+            push_channel.update(json.loads(raw))
+    return True
+
+def save_shared_push_channel():
+    with push_channel_lock:
+        channel = dict(push_channel)
+    ttl = int(channel["expiration"] - time.time()) if channel["expiration"] else CALENDAR_CHANNEL_TTL_SECONDS
+    try:
+        redis_client.set(PUSH_CHANNEL_KEY, json.dumps(channel), ex=max(1, ttl))
+    except redis.RedisError as e:
+        logger.warning(f"Não foi possível compartilhar o canal push com os demais workers: {e}")
+
+def start_calendar_watch():
+    sync_calendar_mirror(force=True)
+    body = {
+        "id": str(uuid.uuid4()),
+        "type": "web_hook",
+        "address": CALENDAR_WEBHOOK_URL,
+        "params": {"ttl": str(CALENDAR_CHANNEL_TTL_SECONDS)},
+        "token": CALENDAR_WEBHOOK_TOKEN,
+    }
+    channel = require_calendar_service().events().watch(calendarId=CALENDAR_ID, body=body).execute()
+    with push_channel_lock:
+        old_channel_id, old_resource_id = push_channel["id"], push_channel["resource_id"]
+        push_channel.update({
+            "id": channel["id"],
+            "resource_id": channel.get("resourceId"),
+            "expiration": int(channel["expiration"]) / 1000 if channel.get("expiration") else None,
+        })
+    save_shared_push_channel()
+    logger.info(f"Canal push {channel['id']} registrado até {channel.get('expiration')}")
+    if old_channel_id:
+        stop_calendar_watch(old_channel_id, old_resource_id)
+
+def handle_calendar_notification(headers):
+    channel_id = headers.get("X-Goog-Channel-ID")
+    with push_channel_lock:
+        expected_channel_id = push_channel["id"]
+    if channel_id and channel_id != expected_channel_id and load_shared_push_channel():
+        # O canal pode ter sido renovado por outro worker desde a última leitura
+        with push_channel_lock:
+            expected_channel_id = push_channel["id"]
+    if not channel_id or channel_id != expected_channel_id:
+        logger.warning(f"Notificação de canal desconhecido ignorada: {channel_id}")
+        return 404
+    if not hmac.compare_digest(headers.get("X-Goog-Channel-Token") or "", CALENDAR_WEBHOOK_TOKEN):
+        logger.warning(f"Notificação com token inválido no canal {channel_id}")
+        return 403
+    resource_state = headers.get("X-Goog-Resource-State")
+    if resource_state == "sync":
+        logger.debug(f"Canal push {channel_id} confirmado pelo Google")
+        return 200
+    try:
+        changed_dates = sync_calendar_mirror(force=True)
+        invalidate_availability(changed_dates)
+        logger.info(f"Notificação push ({resource_state}): {len(changed_dates)} dia(s) invalidado(s)")
+    except Exception as e:
+        logger.error(f"Erro ao processar notificação push: {str(e)}\n{traceback.format_exc()}")
+        with cache_lock:
+            busy_info_cache.clear()
+        # Sem isso o espelho ficaria defasado até o próximo ciclo de AVAILABILITY_PUSH_TTL
+        with mirror_lock:
+            calendar_mirror["last_sync"] = None
+    return 200
+
+class CalendarNotificationHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        status = handle_calendar_notification(self.headers)
+        self.send_response(status)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(f"Webhook do calendário: {format % args}")
+
+def start_notification_server():
+    try:
+        server = HTTPServer(("0.0.0.0", CALENDAR_WEBHOOK_PORT), CalendarNotificationHandler)
+    except OSError as e:
+        # Outro worker deste host já atende a porta; ele sincroniza e propaga as invalidações a todos
+        logger.info(f"Porta {CALENDAR_WEBHOOK_PORT} já em uso, notificações push atendidas por outro worker: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, name="calendar-webhook", daemon=True).start()
+    logger.info(f"Servidor de notificações do calendário ouvindo na porta {CALENDAR_WEBHOOK_PORT}")
+    return server
+
+async def renew_calendar_watch(context: ContextTypes.DEFAULT_TYPE):
+    interval = context.job.data["interval"]
+    shared = load_shared_push_channel()
+    with push_channel_lock:
+        expiration = push_channel["expiration"]
+    if expiration is not None and expiration - time.time() > 2 * interval:
+        return
+    if shared:
+        try:
+            is_leader = redis_client.set(PUSH_CHANNEL_LEADER_KEY, WORKER_ID, nx=True, ex=interval)
+        except redis.RedisError:
+            is_leader = True
+        if not is_leader:
+            logger.debug("Canal push renovado por outro worker")
+            return
+    try:
+        await run_calendar(start_calendar_watch)
+    except Exception as e:
+        logger.error(f"Erro ao renovar canal push do calendário, usando TTL curto: {str(e)}\n{traceback.format_exc()}")
+
 # --- CARREGAR MEMÓRIA ---
 def load_memory():
     try:
@@ -236,9 +1421,54 @@ def get_submenu(category, page=0, items_per_page=10):
     return InlineKeyboardMarkup(buttons), None
 
 # --- SISTEMA DE AGENDAMENTO ---
+async def clear_scheduling_state(context: ContextTypes.DEFAULT_TYPE):
+    """Encerra o agendamento em andamento: libera a reserva do horário e cancela o timer de inatividade."""
+    agendamento = context.user_data.get("agendamento")
+    if not agendamento:
+        return
+    await release_slot(context)
+    await settle_waitlist_entry(agendamento)
+    if agendamento.get("timeout_job"):
+        for job in context.job_queue.get_jobs_by_name(agendamento["timeout_job"]):
+            job.schedule_removal()
+    context.user_data.pop("agendamento", None)
+
+def touch_scheduling(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    agendamento = context.user_data.get("agendamento")
+    if not agendamento:
+        return
+    job_name = f"agendamento_inativo:{update.effective_user.id}"
+    for job in context.job_queue.get_jobs_by_name(job_name):
+        job.schedule_removal()
+    context.job_queue.run_once(
+        expire_scheduling, when=SCHEDULING_INACTIVITY_TIMEOUT,
+        chat_id=update.effective_chat.id, user_id=update.effective_user.id, name=job_name
+    )
+    agendamento["timeout_job"] = job_name
+
+async def expire_scheduling(context: ContextTypes.DEFAULT_TYPE):
+    agendamento = context.user_data.get("agendamento")
+    if not agendamento or agendamento.get("confirmando"):
+        return
+    had_hold = "lease" in agendamento
+    agendamento.pop("timeout_job", None)
+    await clear_scheduling_state(context)
+    context.user_data.pop("current_month", None)
+    logger.info(f"Agendamento do usuário {context.job.user_id} encerrado por inatividade")
+    try:
+        await context.bot.send_message(
+            chat_id=context.job.chat_id,
+            text="⌛ Seu agendamento foi encerrado por inatividade"
+            + (" e o horário reservado foi liberado." if had_hold else ".")
+            + "\n\nQuando quiser, é só começar de novo pelo menu.",
+            reply_markup=get_main_menu(),
+        )
+    except Exception as e:
+        logger.warning(f"Não foi possível avisar sobre o agendamento encerrado: {e}")
+
 async def start_scheduling(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        context.user_data.pop("agendamento", None)
+        await clear_scheduling_state(context)
         context.user_data.pop("current_month", None)
         keyboard = [[InlineKeyboardButton("🔙 Voltar ao Menu", callback_data="main_menu")]]
         await update.effective_message.reply_text(
@@ -247,6 +1477,7 @@ async def start_scheduling(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode="Markdown",
         )
         context.user_data["agendamento"] = {"etapa": "nome"}
+        touch_scheduling(update, context)
         logger.info(f"Iniciando agendamento - Etapa: nome")
     except Exception as e:
         logger.error(f"Erro em start_scheduling: {str(e)}\n{traceback.format_exc()}")
@@ -258,7 +1489,7 @@ async def collect_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not agendamento or "etapa" not in agendamento:
             logger.error("Estado de agendamento inválido")
             await send_error_message(update, context, "estado de agendamento perdido")
-            context.user_data.pop("agendamento", None)
+            await clear_scheduling_state(context)
             return
         keyboard = [[InlineKeyboardButton("🔙 Voltar ao Menu", callback_data="main_menu")]]
         if agendamento.get("etapa") == "nome":
@@ -310,13 +1541,13 @@ async def show_month_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE
             year = current_year
             month = current_month
             context.user_data["current_month"] = {"year": year, "month": month}
-        start_date = datetime(year, month, 1).date()
-        if month == 12:
-            end_date = datetime(year + 1, 1, 1).date()
+        start_date, end_date = get_month_range(year, month)
+        # Só dias abertos a partir de hoje precisam de disponibilidade; sem nenhum, não há chamada à API
+        open_days = SCHEDULE.open_days(max(start_date, current_date), end_date)
+        if open_days:
+            busy_info = await get_busy_info_async(open_days[0], open_days[-1] + timedelta(days=1))
         else:
-            end_date = datetime(year, month + 1, 1).date()
-        busy_info = get_busy_info(start_date, end_date)
-        busy_days_total = busy_info["total"]
+            busy_info = {"slots": {}, "total": {}, "capacity": {}, "stale": False}
         month_name = calendar.month_name[month]
         keyboard = [
             [
@@ -333,24 +1564,29 @@ async def show_month_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE
                 if day == 0:
                     week_buttons.append(InlineKeyboardButton(" ", callback_data="ignore"))
                 else:
-                    is_past_day = datetime(year, month, day).date() < current_date
-                    is_day_full = busy_days_total.get(day, 0) >= MAX_APPOINTMENTS_PER_DAY
-                    if is_past_day:
+                    day_date = datetime(year, month, day).date()
+                    if day_date < current_date:
                         btn_text = f"({day})"
                         callback = "ignore"
-                    elif is_day_full:
-                        btn_text = f"{day}X"
+                    elif SCHEDULE.is_closed(day_date):
+                        btn_text = f"{day}🔒"
                         callback = "ignore"
+                    elif is_day_full(busy_info, day_date):
+                        btn_text = f"{day}X"
+                        callback = f"cal_wait_{year}_{month}_{day}"
                     else:
                         btn_text = str(day)
                         callback = f"cal_day_{year}_{month}_{day}"
                     week_buttons.append(InlineKeyboardButton(btn_text, callback_data=callback))
             keyboard.append(week_buttons)
+        keyboard.append([InlineKeyboardButton("⚡ Próximos horários livres", callback_data="cal_next_slots")])
         keyboard.append([InlineKeyboardButton("🔙 Voltar ao Menu", callback_data="main_menu")])
         message_text = (
             "📅 **Selecione um dia disponível:**\n"
-            "(X indica agenda cheia, () indica data passada)"
+            "(X indica agenda cheia — toque para entrar na lista de espera, () indica data passada, 🔒 indica dia sem atendimento)"
         )
+        if busy_info.get("stale"):
+            message_text += STALE_AVAILABILITY_HINT
         if update.callback_query:
             await update.callback_query.message.edit_text(
                 message_text,
@@ -370,73 +1606,616 @@ async def show_month_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE
         logger.error(f"Erro em show_month_calendar: {str(e)}\n{traceback.format_exc()}")
         await send_error_message(update, context, "ao mostrar o calendário")
 
+# --- EXPEDIENTE (GRADE DE HORÁRIOS COMPILADA) ---
+WEEKDAY_NAMES = ["seg", "ter", "qua", "qui", "sex", "sab", "dom"]
+
+def parse_minutes(hhmm):
+    hours, minutes = hhmm.strip().split(":")
+    return int(hours) * 60 + int(minutes)
+
+def parse_time_range(text):
+    start, end = text.split("-")
+    return parse_minutes(start), parse_minutes(end)
+
+def parse_weekdays(text):
+    weekdays = set()
+    for part in text.split(","):
+        part = part.strip().lower()
+        if "-" in part:
+            first, last = (WEEKDAY_NAMES.index(name.strip()) for name in part.split("-"))
+            weekdays.update(range(first, last + 1))
+        elif part:
+            weekdays.add(WEEKDAY_NAMES.index(part))
+    return weekdays
+
+def parse_business_hours(text):
+    if not text.strip():
+        return {weekday: (START_HOUR * 60, END_HOUR * 60 + APPOINTMENT_DURATION_MINUTES) for weekday in range(7)}
+    hours = {}
+    for entry in text.split(";"):
+        if entry.strip():
+            weekdays_text, range_text = entry.split("=")
+            for weekday in parse_weekdays(weekdays_text):
+                hours[weekday] = parse_time_range(range_text)
+    return hours
+
+def parse_holidays(text):
+    fixed, recurring = set(), set()
+    for item in text.split(","):
+        item = item.strip()
+        if item.count("-") == 2:
+            fixed.add(datetime.strptime(item, "%Y-%m-%d").date())
+        elif item:
+            month, day = item.split("-")
+            recurring.add((int(month), int(day)))
+    return fixed, recurring
+
+class Schedule:
+    """Grade de horários compilada uma vez: índices de horário abertos por dia da semana e feriados."""
+
+    def __init__(self, weekday_hours, breaks, holidays, recurring_holidays, duration):
+        self.duration = duration
+        self.holidays = frozenset(holidays)
+        self.recurring_holidays = frozenset(recurring_holidays)
+        # A grade global vai da abertura mais cedo ao fechamento mais tarde; cada dia usa um subconjunto dela
+        self.origin = min((start for start, _ in weekday_hours.values()), default=START_HOUR * 60)
+        closing = min(max((end for _, end in weekday_hours.values()), default=self.origin), 24 * 60)
+        slot_minutes = range(self.origin, closing - duration + 1, duration)
+        self.slot_times = tuple((datetime.min + timedelta(minutes=minutes)).time() for minutes in slot_minutes)
+        self.slot_labels = tuple(slot_time.strftime("%H:%M") for slot_time in self.slot_times)
+        self.slot_index = {label: idx for idx, label in enumerate(self.slot_labels)}
+        self.weekday_slots = tuple(
+            tuple(
+                idx for idx, minutes in enumerate(slot_minutes)
+                if weekday in weekday_hours
+                and weekday_hours[weekday][0] <= minutes and minutes + duration <= weekday_hours[weekday][1]
+                and not any(minutes < break_end and break_start < minutes + duration for break_start, break_end in breaks)
+            )
+            for weekday in range(7)
+        )
+
+    def is_closed(self, day_date):
+        return (
+            day_date in self.holidays
+            or (day_date.month, day_date.day) in self.recurring_holidays
+            or not self.weekday_slots[day_date.weekday()]
+        )
+
+    def open_slots(self, day_date):
+        return () if self.is_closed(day_date) else self.weekday_slots[day_date.weekday()]
+
+    def is_open_slot(self, day_date, slot_str):
+        return self.slot_index.get(slot_str) in self.open_slots(day_date)
+
+    def open_days(self, start_date, end_date):
+        days = (start_date + timedelta(days=i) for i in range((end_date - start_date).days))
+        return [day_date for day_date in days if not self.is_closed(day_date)]
+
+def compile_schedule():
+    breaks = [parse_time_range(item) for item in SCHEDULE_BREAKS.split(",") if item.strip()]
+    holidays, recurring_holidays = parse_holidays(HOLIDAYS)
+    schedule = Schedule(parse_business_hours(BUSINESS_HOURS), breaks, holidays, recurring_holidays, APPOINTMENT_DURATION_MINUTES)
+    logger.info(
+        f"Expediente compilado: {len(schedule.slot_labels)} horário(s) na grade, "
+        f"{sum(1 for slots in schedule.weekday_slots if slots)} dia(s) da semana abertos, "
+        f"{len(holidays) + len(recurring_holidays)} feriado(s)"
+    )
+    return schedule
+
+SCHEDULE = compile_schedule()
+
+# --- ÍNDICE DE OCUPAÇÃO DOS HORÁRIOS ---
+SLOT_TIMES = SCHEDULE.slot_times
+POSSIBLE_SLOTS = SCHEDULE.slot_labels
+SLOT_INDEX = SCHEDULE.slot_index
+
+def new_occupancy():
+    return array("H", [0]) * len(POSSIBLE_SLOTS)
+
+def get_slot_index(event_time):
+    offset = event_time.hour * 60 + event_time.minute - SCHEDULE.origin
+    if offset < 0:
+        return None
+    slot_index = offset // APPOINTMENT_DURATION_MINUTES
+    return slot_index if slot_index < len(POSSIBLE_SLOTS) else None
+
+def get_slot_capacity(busy_info, day_date, slot_index):
+    capacity = busy_info.get("capacity", {}).get(day_date)
+    if capacity is None:
+        return MAX_CONCURRENT_APPOINTMENTS
+    return capacity[slot_index]
+
+def get_slot_remaining(busy_info, day_date, slot_str):
+    slot_index = SLOT_INDEX.get(slot_str)
+    if slot_index is None:
+        return 0
+    occupancy = busy_info["slots"].get(day_date)
+    booked = occupancy[slot_index] if occupancy is not None else 0
+    return max(0, get_slot_capacity(busy_info, day_date, slot_index) - booked)
+
+def is_slot_full(busy_info, day_date, slot_str):
+    return get_slot_remaining(busy_info, day_date, slot_str) == 0
+
+def get_day_total(busy_info, day_date):
+    return busy_info["total"].get(day_date, 0)
+
+def is_day_full(busy_info, day_date):
+    if get_day_total(busy_info, day_date) >= MAX_APPOINTMENTS_PER_DAY:
+        return True
+    return all(is_slot_full(busy_info, day_date, POSSIBLE_SLOTS[idx]) for idx in SCHEDULE.open_slots(day_date))
+
+# --- DISPONIBILIDADE DOS ATENDENTES (FREEBUSY) ---
+def get_interval_slot_range(interval_start, interval_end):
+    day_start = SCHEDULE.origin
+    start_minutes = interval_start.hour * 60 + interval_start.minute - day_start
+    end_minutes = interval_end.hour * 60 + interval_end.minute - day_start
+    if interval_end.date() > interval_start.date():
+        end_minutes = 24 * 60 - day_start
+    first = max(0, start_minutes // APPOINTMENT_DURATION_MINUTES)
+    last = min(len(POSSIBLE_SLOTS), -(-end_minutes // APPOINTMENT_DURATION_MINUTES))
+    return range(first, last)
+
+def load_attendant_capacity(start_date, end_date):
+    time_min = datetime.combine(start_date, datetime.min.time()).astimezone()
+    time_max = datetime.combine(end_date, datetime.min.time()).astimezone()
+    result = require_calendar_service().freebusy().query(body={
+        "timeMin": time_min.isoformat(),
+        "timeMax": time_max.isoformat(),
+        "items": [{"id": cal_id} for cal_id in ATTENDANT_CALENDAR_IDS],
+    }).execute()
+    calendars = result.get("calendars", {})
+    available_attendants = [cal_id for cal_id in ATTENDANT_CALENDAR_IDS if not calendars.get(cal_id, {}).get("errors")]
+    for cal_id in set(ATTENDANT_CALENDAR_IDS) - set(available_attendants):
+        logger.warning(f"Agenda do atendente {cal_id} indisponível no freebusy: {calendars.get(cal_id, {}).get('errors')}")
+    capacity = {}
+    current_date = start_date
+    while current_date < end_date:
+        capacity[current_date] = array("H", [len(available_attendants)]) * len(POSSIBLE_SLOTS)
+        current_date += timedelta(days=1)
+    for cal_id in available_attendants:
+        for busy in calendars[cal_id].get("busy", []):
+            busy_start = datetime.fromisoformat(busy["start"].replace("Z", "+00:00")).astimezone()
+            busy_end = datetime.fromisoformat(busy["end"].replace("Z", "+00:00")).astimezone()
+            busy_day = max(busy_start.date(), start_date)
+            while busy_day <= busy_end.date() and busy_day < end_date:
+                interval_start = max(busy_start, datetime.combine(busy_day, datetime.min.time()).astimezone())
+                for slot_index in get_interval_slot_range(interval_start, busy_end):
+                    capacity[busy_day][slot_index] = max(0, capacity[busy_day][slot_index] - 1)
+                busy_day += timedelta(days=1)
+    logger.debug(f"Freebusy de {len(available_attendants)} atendente(s) carregado para {start_date}_{end_date}")
+    return capacity
+
+# --- CACHE COMPARTILHADO DE DISPONIBILIDADE (REDIS) ---
+# L1 = busy_info_cache (em processo); L2 = hash por dia no Redis, versionado, compartilhado entre workers.
+WRITE_SHARED_AVAILABILITY_SCRIPT = redis_client.register_script("""
+local current = tonumber(redis.call('GET', KEYS[2]) or '0')
+if current ~= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'version', ARGV[1], 'slots', ARGV[2], 'total', ARGV[3], 'capacity', ARGV[4], 'fetched_at', ARGV[5])
+redis.call('EXPIRE', KEYS[1], ARGV[6])
+return 1
+""")
+
+def availability_key(day_date):
+    return f"availability:{day_date.isoformat()}"
+
+def availability_version_key(day_date):
+    return f"availability:version:{day_date.isoformat()}"
+
+def decode_shared_availability(data):
+    slots = array("H")
+    slots.frombytes(data[b"slots"])
+    capacity = None
+    if data[b"capacity"]:
+        capacity = array("H")
+        capacity.frombytes(data[b"capacity"])
+    return {"slots": slots, "total": int(data[b"total"]), "capacity": capacity, "fetched_at": float(data[b"fetched_at"])}
+
+def read_shared_availability(days):
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for day_date in days:
+            pipe.hgetall(availability_key(day_date))
+            pipe.get(availability_version_key(day_date))
+        results = pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Cache compartilhado indisponível na leitura: {e}")
+        return {}
+    entries = {}
+    for day_date, data, version in zip(days, results[::2], results[1::2]):
+        if data and int(data[b"version"]) == int(version or 0):
+            entries[day_date] = decode_shared_availability(data)
+    return entries
+
+def read_shared_versions(days):
+    try:
+        return {day_date: int(version or 0) for day_date, version in zip(days, redis_client.mget([availability_version_key(d) for d in days]))}
+    except redis.RedisError as e:
+        logger.warning(f"Cache compartilhado indisponível ao ler versões: {e}")
+        return None
+
+def write_shared_availability(day_entries, versions):
+    if versions is None:
+        return set(day_entries)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for day_date, entry in day_entries.items():
+            WRITE_SHARED_AVAILABILITY_SCRIPT(
+                keys=[availability_key(day_date), availability_version_key(day_date)],
+                args=[
+                    versions[day_date],
+                    entry["slots"].tobytes(),
+                    entry["total"],
+                    entry["capacity"].tobytes() if entry["capacity"] is not None else b"",
+                    entry["fetched_at"],
+                    AVAILABILITY_MAX_TTL,
+                ],
+                client=pipe,
+            )
+        written = pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Cache compartilhado indisponível na escrita: {e}")
+        return set(day_entries)
+    return {day_date for day_date, ok in zip(day_entries, written) if ok}
+
+def invalidate_shared_availability(dates):
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for changed_date in dates:
+            pipe.incr(availability_version_key(changed_date))
+            pipe.expire(availability_version_key(changed_date), AVAILABILITY_MAX_TTL * 2)
+            pipe.delete(availability_key(changed_date))
+        pipe.publish(AVAILABILITY_INVALIDATION_CHANNEL, json.dumps({
+            "origin": WORKER_ID,
+            "dates": [changed_date.isoformat() for changed_date in dates],
+        }))
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Não foi possível propagar a invalidação do cache compartilhado: {e}")
+
+def handle_invalidation_message(message):
+    try:
+        payload = json.loads(message["data"])
+    except (TypeError, ValueError):
+        logger.warning(f"Mensagem de invalidação inválida: {message.get('data')}")
+        return
+    if payload.get("origin") == WORKER_ID:
+        return
+    dates = [datetime.strptime(day_str, "%Y-%m-%d").date() for day_str in payload.get("dates", [])]
+    with cache_lock:
+        for changed_date in dates:
+            busy_info_cache.pop(changed_date, None)
+        record_availability_changes(dates)
+    with mirror_lock:
+        calendar_mirror["last_sync"] = None
+    logger.debug(f"Invalidação recebida de outro worker para {len(dates)} dia(s)")
+
+def start_invalidation_listener():
+    try:
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{AVAILABILITY_INVALIDATION_CHANNEL: handle_invalidation_message})
+        pubsub.run_in_thread(sleep_time=1, daemon=True)
+        logger.info("Ouvindo invalidações do cache de disponibilidade")
+    except redis.RedisError as e:
+        logger.warning(f"Redis indisponível, cache de disponibilidade apenas local: {e}")
+
+def invalidate_availability(dates):
+    if not dates:
+        return
+    with cache_lock:
+        for changed_date in dates:
+            busy_info_cache.pop(changed_date, None)
+        record_availability_changes(dates)
+    invalidate_shared_availability(dates)
+    logger.debug(f"Disponibilidade invalidada para {len(dates)} dia(s)")
+
+def write_through_availability(event, delta):
+    event_datetime = get_event_start(event)
+    if not event_datetime:
+        return
+    with cache_lock:
+        record_availability_changes([event_datetime.date()])
+        entry = busy_info_cache.get(event_datetime.date())
+        if entry is None:
+            return
+        slots = array("H", entry["slots"])
+        slot_index = get_slot_index(event_datetime.time())
+        if slot_index is not None:
+            slots[slot_index] = max(0, slots[slot_index] + delta)
+        busy_info_cache[event_datetime.date()] = dict(entry, slots=slots, total=max(0, entry["total"] + delta))
+    invalidate_shared_availability([event_datetime.date()])
+
+def load_day_availability(start_date, end_date):
+    invalidate_availability(sync_calendar_mirror())
+    day_entries = {}
+    fetched_at = time.time()
+    versions = read_shared_versions([start_date + timedelta(days=i) for i in range((end_date - start_date).days)])
+    current_date = start_date
+    while current_date < end_date:
+        day_entries[current_date] = {"slots": new_occupancy(), "total": 0, "capacity": None, "fetched_at": fetched_at}
+        current_date += timedelta(days=1)
+    if ATTENDANT_CALENDAR_IDS:
+        for day_date, capacity in load_attendant_capacity(start_date, end_date).items():
+            day_entries[day_date]["capacity"] = capacity
+    events = get_mirror_events(start_date, end_date)
+    for event in events:
+        event_datetime = get_event_start(event)
+        if not event_datetime:
+            continue
+        entry = day_entries[event_datetime.date()]
+        entry["total"] += 1
+        slot_index = get_slot_index(event_datetime.time())
+        if slot_index is not None:
+            entry["slots"][slot_index] += 1
+    written = write_shared_availability(day_entries, versions)
+    with cache_lock:
+        busy_info_cache.update({day_date: entry for day_date, entry in day_entries.items() if day_date in written})
+    logger.debug(f"Eventos processados: {len(events)}")
+    logger.info(f"Cache atualizado para {start_date.isoformat()}_{end_date.isoformat()}")
+    return day_entries
+
+def load_day_availability_coalesced(start_date, end_date):
+    with inflight_lock:
+        future = next(
+            (f for (s, e), f in inflight_loads.items() if s <= start_date and end_date <= e),
+            None
+        )
+        is_leader = future is None
+        if is_leader:
+            future = Future()
+            inflight_loads[(start_date, end_date)] = future
+    if not is_leader:
+        logger.debug(f"Aguardando carregamento em andamento para {start_date.isoformat()}_{end_date.isoformat()}")
+        day_entries = future.result()
+        return {day_date: entry for day_date, entry in day_entries.items() if start_date <= day_date < end_date}
+    try:
+        day_entries = load_day_availability(start_date, end_date)
+        future.set_result(day_entries)
+        return day_entries
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with inflight_lock:
+            inflight_loads.pop((start_date, end_date), None)
+
+def get_month_range(year, month):
+    start_date = datetime(year, month, 1).date()
+    if month == 12:
+        end_date = datetime(year + 1, 1, 1).date()
+    else:
+        end_date = datetime(year, month + 1, 1).date()
+    return start_date, end_date
+
+def record_availability_changes(dates):
+    # Chamada com cache_lock adquirido
+    now = time.time()
+    for changed_date in dates:
+        recent = [t for t in availability_changes.get(changed_date, []) if now - t < AVAILABILITY_CHANGE_WINDOW]
+        availability_changes[changed_date] = recent[-19:] + [now]
+    if len(availability_changes) > busy_info_cache.maxsize:
+        today = datetime.now().date()
+        for day_date in [d for d in availability_changes if d < today]:
+            del availability_changes[day_date]
+
+def availability_cache_ttl(day_date):
+    # Com canal push ativo as alterações chegam por notificação; sem ele, o TTL cai conforme o dia se
+    # aproxima de hoje e conforme a quantidade de alterações recentes naquele dia.
+    if push_channel_active():
+        return AVAILABILITY_PUSH_TTL
+    days_ahead = (day_date - datetime.now().date()).days
+    if days_ahead == 0:
+        base_ttl = AVAILABILITY_TTL_TODAY
+    elif 0 < days_ahead <= 7:
+        base_ttl = AVAILABILITY_CACHE_TTL
+    elif 0 < days_ahead <= 31:
+        base_ttl = AVAILABILITY_TTL_MONTH
+    else:
+        base_ttl = AVAILABILITY_TTL_FAR
+    now = time.time()
+    recent_changes = sum(1 for t in availability_changes.get(day_date, ()) if now - t < AVAILABILITY_CHANGE_WINDOW)
+    return max(AVAILABILITY_TTL_MIN, base_ttl / (1 + recent_changes))
+
+def is_availability_fresh(day_date, entry, now):
+    return now - entry["fetched_at"] < availability_cache_ttl(day_date)
+
+def expired_availability_days(start_date, end_date):
+    range_days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days)]
+    now = time.time()
+    with cache_lock:
+        return [
+            day_date for day_date in range_days
+            if day_date not in busy_info_cache or not is_availability_fresh(day_date, busy_info_cache[day_date], now)
+        ]
+
+def get_availability_cache_stats():
+    with cache_lock:
+        busy_info_cache.expire()
+        stats = dict(busy_info_cache.stats, size=len(busy_info_cache), maxsize=busy_info_cache.maxsize)
+    lookups = stats["hits"] + stats["stale_hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else None
+    return stats
+
+async def log_availability_cache_stats(context: ContextTypes.DEFAULT_TYPE):
+    logger.info(f"Cache de disponibilidade: {get_availability_cache_stats()}")
+
+def assemble_busy_info(day_entries, stale=False):
+    # Soma os agendamentos já confirmados no livro local que ainda não chegaram ao Google
+    unsynced = {}
+    if day_entries:
+        try:
+            unsynced = load_unsynced_bookings(min(day_entries), max(day_entries) + timedelta(days=1))
+        except sqlite3.Error as e:
+            logger.warning(f"Não foi possível ler os agendamentos pendentes do livro local: {e}")
+    occupancy = {day_date: overlay_pending_bookings(entry, unsynced.get(day_date)) for day_date, entry in day_entries.items()}
+    return {
+        "slots": {day_date: slots for day_date, (slots, _) in occupancy.items()},
+        "total": {day_date: total for day_date, (_, total) in occupancy.items()},
+        "capacity": {day_date: entry["capacity"] for day_date, entry in day_entries.items()},
+        "stale": stale,
+    }
+
+def get_cached_busy_info(start_date, end_date):
+    range_days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days)]
+    now = time.time()
+    with cache_lock:
+        day_entries = {day_date: busy_info_cache[day_date] for day_date in range_days if day_date in busy_info_cache}
+        stale_days = [day_date for day_date, entry in day_entries.items() if not is_availability_fresh(day_date, entry, now)]
+        busy_info_cache.stats["hits"] += len(day_entries) - len(stale_days)
+        busy_info_cache.stats["stale_hits"] += len(stale_days)
+        busy_info_cache.stats["misses"] += len(range_days) - len(day_entries)
+    if len(day_entries) < len(range_days):
+        return None
+    return assemble_busy_info(day_entries, bool(stale_days))
+
 def get_busy_info(start_date, end_date):
-    cache_key = f"{start_date.isoformat()}_{end_date.isoformat()}"
+    range_days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days)]
+    now = time.time()
     with cache_lock:
-        if cache_key in busy_info_cache:
-            logger.debug(f"Cache hit para {cache_key}")
-            return busy_info_cache[cache_key]
-    try:
-        service = get_calendar_service()
-        if not service:
-            logger.warning("Serviço do Google Calendar não disponível")
-            return {"hourly": {}, "total": {}}
-        start_time_search = datetime.combine(start_date, datetime.min.time()).isoformat() + "Z"
-        end_time_search = datetime.combine(end_date, datetime.min.time()).isoformat() + "Z"
-        events_result = service.events().list(
-            calendarId=CALENDAR_ID,
-            timeMin=start_time_search,
-            timeMax=end_time_search,
-            singleEvents=True,
-            orderBy="startTime"
-        ).execute()
-        busy_days_slots = {}
-        busy_days_total = {}
-        possible_slots = []
-        current_time = datetime.min.replace(hour=START_HOUR).time()
-        end_time_limit = datetime.min.replace(hour=END_HOUR).time()
-        while current_time <= end_time_limit:
-            possible_slots.append(current_time.strftime("%H:%M"))
-            current_datetime = datetime.combine(datetime.min.date(), current_time) + timedelta(minutes=APPOINTMENT_DURATION_MINUTES)
-            current_time = current_datetime.time()
-        for event in events_result.get("items", []):
-            logger.debug(f"Processando evento: {event.get('summary', 'Sem título')} - Início: {event.get('start', {}).get('dateTime', 'Sem data')}")
-            start = event["start"].get("dateTime")
-            if start:
-                try:
-                    event_datetime = datetime.fromisoformat(start.replace("Z", "+00:00")).astimezone()
-                    event_date = event_datetime.date()
-                    day = event_date.day
-                    event_start_time = event_datetime.time()
-                    if day not in busy_days_slots:
-                        busy_days_slots[day] = {slot: 0 for slot in possible_slots}
-                    if day not in busy_days_total:
-                        busy_days_total[day] = 0
-                    busy_days_total[day] += 1
-                    for slot_str in possible_slots:
-                        slot_time = datetime.strptime(slot_str, "%H:%M").time()
-                        slot_end_time = (datetime.combine(datetime.min.date(), slot_time) + timedelta(minutes=APPOINTMENT_DURATION_MINUTES)).time()
-                        if slot_time <= event_start_time < slot_end_time or (
-                            slot_end_time <= slot_time and (event_start_time >= slot_time or event_start_time < slot_end_time)
-                        ):
-                            busy_days_slots[day][slot_str] += 1
-                            break
-                except ValueError:
-                    logger.warning(f"Formato de data/hora inválido em evento: {start}")
-                    continue
-        full_slots_per_day = {day: [slot for slot, count in slots.items() if count >= MAX_CONCURRENT_APPOINTMENTS]
-                            for day, slots in busy_days_slots.items()}
-        result = {"hourly": full_slots_per_day, "total": busy_days_total}
-        logger.debug(f"Eventos processados: {len(events_result.get('items', []))}")
-        logger.debug(f"Dias com eventos: {busy_days_total}")
-        logger.debug(f"Slots ocupados por dia: {busy_days_slots}")
+        day_entries = {
+            day_date: busy_info_cache[day_date] for day_date in range_days
+            if day_date in busy_info_cache and is_availability_fresh(day_date, busy_info_cache[day_date], now)
+        }
+    missing_days = [day_date for day_date in range_days if day_date not in day_entries]
+    if missing_days:
+        shared_entries = {
+            day_date: entry for day_date, entry in read_shared_availability(missing_days).items()
+            if is_availability_fresh(day_date, entry, now)
+        }
         with cache_lock:
-            busy_info_cache[cache_key] = result
-        logger.info(f"Cache atualizado para {cache_key}")
-        return result
+            busy_info_cache.update(shared_entries)
+            busy_info_cache.stats["shared_hits"] += len(shared_entries)
+        day_entries.update(shared_entries)
+    if len(day_entries) == len(range_days):
+        logger.debug(f"Cache hit para {start_date.isoformat()}_{end_date.isoformat()}")
+    else:
+        day_entries = load_day_availability_coalesced(start_date, end_date)
+    return assemble_busy_info(day_entries)
+
+async def get_busy_info_async(start_date, end_date, allow_stale=True):
+    cached = get_cached_busy_info(start_date, end_date)
+    if cached and not cached["stale"]:
+        return cached
+    stale = cached if allow_stale else None
+    if stale and calendar_circuit_open():
+        logger.info(f"Circuito aberto: servindo disponibilidade em cache para {start_date.isoformat()}_{end_date.isoformat()}")
+        return stale
+    key = (start_date, end_date)
+    task = inflight_async_loads.get(key)
+    if task is None:
+        task = asyncio.ensure_future(run_calendar(get_busy_info, start_date, end_date))
+        inflight_async_loads[key] = task
+        task.add_done_callback(lambda _: inflight_async_loads.pop(key, None))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    if not stale:
+        return await asyncio.shield(task)
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), AVAILABILITY_STALE_TIMEOUT)
     except Exception as e:
-        logger.error(f"Erro em get_busy_info: {str(e)}\n{traceback.format_exc()}")
-        return {"hourly": {}, "total": {}}
+        logger.warning(f"Servindo disponibilidade desatualizada para {start_date.isoformat()}_{end_date.isoformat()} enquanto atualiza: {e!r}")
+        return stale
+
+async def prewarm_availability(context: ContextTypes.DEFAULT_TYPE):
+    base_delay = min(AVAILABILITY_PREWARM_INTERVAL, availability_cache_ttl(datetime.now().date()) * 0.75)
+    delay = context.job.data.get("delay", base_delay)
+    started = time.monotonic()
+    try:
+        try:
+            is_leader = redis_client.set("availability:prewarm:lock", WORKER_ID, nx=True, ex=max(1, int(base_delay * 0.9)))
+        except redis.RedisError:
+            is_leader = True
+        if not is_leader:
+            logger.debug("Pré-aquecimento feito por outro worker neste intervalo")
+            context.job_queue.run_once(prewarm_availability, when=base_delay, data={"delay": base_delay}, name="prewarm_availability")
+            return
+        today = datetime.now().date()
+        year, month = today.year, today.month
+        for _ in range(AVAILABILITY_PREWARM_MONTHS + 1):
+            start_date, end_date = get_month_range(year, month)
+            # Recarrega só o trecho expirado: meses distantes têm TTL longo e raramente entram aqui
+            expired_days = [
+                day_date for day_date in expired_availability_days(max(start_date, today), end_date)
+                if not SCHEDULE.is_closed(day_date)
+            ]
+            if expired_days:
+                await run_calendar(load_day_availability_coalesced, expired_days[0], expired_days[-1] + timedelta(days=1))
+            year, month = end_date.year, end_date.month
+        elapsed = time.monotonic() - started
+        if elapsed > AVAILABILITY_PREWARM_SLOW_SECONDS:
+            delay = min(delay * 2, AVAILABILITY_PREWARM_MAX_INTERVAL)
+            logger.warning(f"Pré-aquecimento lento ({elapsed:.1f}s), próximo em {delay:.0f}s")
+        else:
+            delay = base_delay
+            logger.debug(f"Disponibilidade pré-aquecida em {elapsed:.1f}s")
+    except Exception as e:
+        delay = min(delay * 2, AVAILABILITY_PREWARM_MAX_INTERVAL)
+        logger.error(f"Erro no pré-aquecimento da disponibilidade, próximo em {delay:.0f}s: {str(e)}\n{traceback.format_exc()}")
+    jitter = random.uniform(-0.1, 0.1) * delay
+    context.job_queue.run_once(prewarm_availability, when=delay + jitter, data={"delay": delay}, name="prewarm_availability")
+
+# --- PRÓXIMOS HORÁRIOS LIVRES ---
+def scan_available_slots(busy_info, days, now, limit):
+    found = []
+    for day_date in days:
+        if get_day_total(busy_info, day_date) >= MAX_APPOINTMENTS_PER_DAY:
+            continue
+        for slot_index in SCHEDULE.open_slots(day_date):
+            if day_date == now.date() and SLOT_TIMES[slot_index] < now.time():
+                continue
+            if not is_slot_full(busy_info, day_date, POSSIBLE_SLOTS[slot_index]):
+                found.append(datetime.combine(day_date, SLOT_TIMES[slot_index]))
+                if len(found) == limit:
+                    return found
+    return found
+
+async def find_next_available_slots(limit=NEXT_SLOTS_COUNT, horizon_days=NEXT_SLOTS_HORIZON_DAYS):
+    # Uma única consulta cobre todo o horizonte (busy_info é indexado pela data)
+    now = datetime.now()
+    open_days = SCHEDULE.open_days(now.date(), now.date() + timedelta(days=horizon_days))
+    if not open_days:
+        return [], False
+    busy_info = await get_busy_info_async(open_days[0], open_days[-1] + timedelta(days=1))
+    return scan_available_slots(busy_info, open_days, now, limit), busy_info.get("stale", False)
+
+async def show_next_available_slots(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        if not context.user_data.get("agendamento"):
+            await send_error_message(update, context, "estado de agendamento perdido")
+            return
+        slots, stale = await find_next_available_slots()
+        nav_buttons = [
+            InlineKeyboardButton("📅 Ver calendário", callback_data="cal_back"),
+            InlineKeyboardButton("🔙 Voltar ao Menu", callback_data="main_menu")
+        ]
+        if not slots:
+            await update.callback_query.message.edit_text(
+                f"❌ **Nenhum horário livre nos próximos {NEXT_SLOTS_HORIZON_DAYS} dias.**",
+                reply_markup=InlineKeyboardMarkup([nav_buttons]),
+                parse_mode="Markdown",
+            )
+            return
+        keyboard = []
+        for i in range(0, len(slots), 2):
+            keyboard.append([
+                InlineKeyboardButton(
+                    f"{WEEKDAY_NAMES[slot.weekday()].capitalize()} {slot.day:02d}/{slot.month:02d} {slot.strftime('%H:%M')}",
+                    callback_data=f"cal_time_{slot.year}_{slot.month}_{slot.day}_{slot.strftime('%H%M')}",
+                )
+                for slot in slots[i:i + 2]
+            ])
+        keyboard.append(nav_buttons)
+        await update.callback_query.message.edit_text(
+            "⚡ **Próximos horários livres:**\nEscolha um horário ou abra o calendário completo."
+            + (STALE_AVAILABILITY_HINT if stale else ""),
+            reply_markup=InlineKeyboardMarkup(keyboard),
+            parse_mode="Markdown",
+        )
+        context.user_data["agendamento"]["etapa"] = "horario"
+        logger.info(f"Agendamento - Etapa: horario (próximos horários)")
+    except Exception as e:
+        logger.error(f"Erro em show_next_available_slots: {str(e)}\n{traceback.format_exc()}")
+        await send_error_message(update, context, "ao buscar os próximos horários")
 
 async def show_day_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE, year, month, day):
     try:
@@ -455,56 +2234,72 @@ async def show_day_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE,
                 parse_mode="Markdown",
             )
             return
+        if SCHEDULE.is_closed(selected_date):
+            await update.callback_query.message.edit_text(
+                f"❌ **Não há atendimento em {day}/{month}/{year}.**\nEscolha outra data:",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("🔙 Voltar ao Calendário", callback_data="cal_back")],
+                    [InlineKeyboardButton("🔙 Voltar ao Menu", callback_data="main_menu")]
+                ]),
+                parse_mode="Markdown",
+            )
+            return
         start_date = selected_date
         end_date = selected_date + timedelta(days=1)
-        busy_info = get_busy_info(start_date, end_date)
-        busy_slots_for_day = busy_info["hourly"].get(day, [])
-        busy_total_for_day = busy_info["total"].get(day, 0)
+        # Reservas em andamento vêm do Redis em paralelo com a disponibilidade e ocupam vagas na grade
+        own_lease = context.user_data.get("agendamento", {}).get("lease")
+        busy_info, holds = await asyncio.gather(
+            get_busy_info_async(start_date, end_date),
+            get_day_holds(selected_date, exclude_owner=own_lease["owner"] if own_lease else None),
+        )
         if busy_info is None:
             await send_error_message(update, context, "ao carregar os horários disponíveis")
             return
+        busy_total_for_day = get_day_total(busy_info, selected_date)
         if busy_total_for_day >= MAX_APPOINTMENTS_PER_DAY:
             await update.callback_query.message.edit_text(
                 f"❌ **O dia {day}/{month}/{year} está totalmente ocupado.**\nEscolha outra data:",
                 reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("🔔 Avisar quando vagar", callback_data=f"cal_wait_{year}_{month}_{day}")],
                     [InlineKeyboardButton("🔙 Voltar ao Calendário", callback_data="cal_back")],
                     [InlineKeyboardButton("🔙 Voltar ao Menu", callback_data="main_menu")]
                 ]),
                 parse_mode="Markdown",
             )
             return
-        possible_slots = []
-        current_slot_time = datetime.min.replace(hour=START_HOUR, minute=0, second=0, microsecond=0)
-        end_time_limit = datetime.min.replace(hour=END_HOUR, minute=0, second=0, microsecond=0)
-        while current_slot_time.time() <= end_time_limit.time():
-            possible_slots.append(current_slot_time.strftime("%H:%M"))
-            current_slot_time += timedelta(minutes=APPOINTMENT_DURATION_MINUTES)
         keyboard = []
         current_row = []
         buttons_per_row = 3
-        for slot_str in possible_slots:
-            slot_time = datetime.strptime(slot_str, "%H:%M").time()
+        for slot_index in SCHEDULE.open_slots(selected_date):
+            slot_time, slot_str = SLOT_TIMES[slot_index], POSSIBLE_SLOTS[slot_index]
             btn_text = slot_str
             callback = f"cal_time_{year}_{month}_{day}_{slot_str.replace(':', '')}"
             is_past_slot = (selected_date == current_date and slot_time < current_time)
-            is_busy = slot_str in busy_slots_for_day
-            if is_past_slot or is_busy:
+            is_busy = get_slot_remaining(busy_info, selected_date, slot_str) <= holds.get(slot_str, 0)
+            if is_past_slot:
                 btn_text = f"{slot_str}X"
                 callback = "ignore"
+            elif is_busy:
+                btn_text = f"{slot_str}X"
+                callback = f"cal_wait_{year}_{month}_{day}_{slot_str.replace(':', '')}"
             current_row.append(InlineKeyboardButton(btn_text, callback_data=callback))
-            if len(current_row) == buttons_per_row or slot_str == possible_slots[-1]:
+            if len(current_row) == buttons_per_row:
                 keyboard.append(current_row)
                 current_row = []
+        if current_row:
+            keyboard.append(current_row)
         nav_buttons = [
             InlineKeyboardButton("🔙 Voltar ao Calendário", callback_data="cal_back"),
             InlineKeyboardButton("🔙 Voltar ao Menu", callback_data="main_menu")
         ]
         keyboard.append(nav_buttons)
-        available_slots_count = sum(1 for row in keyboard[:-1] for button in row if button.callback_data != "ignore")
+        available_slots_count = sum(1 for row in keyboard[:-1] for button in row if button.callback_data.startswith("cal_time_"))
+        has_waitlist_slots = any(button.callback_data.startswith("cal_wait_") for row in keyboard[:-1] for button in row)
         if available_slots_count == 0:
+            waitlist_row = [[InlineKeyboardButton("🔔 Avisar quando vagar", callback_data=f"cal_wait_{year}_{month}_{day}")]] if has_waitlist_slots else []
             await update.callback_query.message.edit_text(
                 f"❌ **{day}/{month}/{year} totalmente ocupado**\nEscolha outra data:",
-                reply_markup=InlineKeyboardMarkup([
+                reply_markup=InlineKeyboardMarkup(waitlist_row + [
                     [InlineKeyboardButton("🔙 Voltar ao Calendário", callback_data="cal_back")],
                     [InlineKeyboardButton("🔙 Voltar ao Menu", callback_data="main_menu")]
                 ]),
@@ -512,7 +2307,8 @@ async def show_day_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE,
             )
         else:
             await update.callback_query.message.edit_text(
-                f"⏰ **Horários disponíveis para {day}/{month}/{year}:**\n(X indica horário ocupado ou passado)",
+                f"⏰ **Horários disponíveis para {day}/{month}/{year}:**\n(X indica horário ocupado, reservado ou passado; toque num horário ocupado para entrar na lista de espera)"
+                + (STALE_AVAILABILITY_HINT if busy_info.get("stale") else ""),
                 reply_markup=InlineKeyboardMarkup(keyboard),
                 parse_mode="Markdown",
             )
@@ -523,41 +2319,548 @@ async def show_day_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE,
         logger.error(f"Erro em show_day_schedule: {str(e)}\n{traceback.format_exc()}")
         await send_error_message(update, context, "ao mostrar horários disponíveis")
 
-def reserve_slot(year, month, day, hour):
-    slot_key = f"slot:{year}:{month}:{day}:{hour}"
-    ttl_seconds = 300
+# --- RESERVAS TEMPORÁRIAS DE HORÁRIO (REDIS) ---
+# Todas as reservas de um dia ficam num único sorted set (membro "HH:MM|dono|vaga", pontuação = expiração no
+# relógio do Redis); cada horário funciona como um semáforo contador sobre os membros com o seu prefixo.
+# Agendamentos em grupo/recorrentes reservam todas as vagas de todas as datas no mesmo script (tudo ou nada).
+# Só quem tem o token renova ou libera as próprias vagas; reservas expiradas são descartadas a cada chamada.
+ACQUIRE_SLOT_LEASE_SCRIPT = async_redis_client.register_script("""
+local now = tonumber(redis.call('TIME')[1])
+local prefix = ARGV[1]
+local own = prefix .. ARGV[2] .. '|'
+local seats = tonumber(ARGV[3])
+local remaining = {}
+for i, key in ipairs(KEYS) do
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now)
+    local others = 0
+    for _, member in ipairs(redis.call('ZRANGE', key, 0, -1)) do
+        if string.sub(member, 1, #prefix) == prefix and string.sub(member, 1, #own) ~= own then
+            others = others + 1
+        end
+    end
+    local free = tonumber(ARGV[5 + i]) - others
+    if free < seats then
+        return {0, i}
+    end
+    remaining[i] = free - seats
+end
+for _, key in ipairs(KEYS) do
+    for _, member in ipairs(redis.call('ZRANGE', key, 0, -1)) do
+        if string.sub(member, 1, #own) == own then
+            redis.call('ZREM', key, member)
+        end
+    end
+    for seat = 1, seats do
+        redis.call('ZADD', key, now + tonumber(ARGV[4]), own .. seat)
+    end
+    redis.call('EXPIRE', key, ARGV[5])
+end
+return {1, unpack(remaining)}
+""")
+
+RELEASE_SLOT_LEASE_SCRIPT = async_redis_client.register_script("""
+local removed = 0
+for _, key in ipairs(KEYS) do
+    for _, member in ipairs(redis.call('ZRANGE', key, 0, -1)) do
+        if string.sub(member, 1, #ARGV[1]) == ARGV[1] then
+            removed = removed + redis.call('ZREM', key, member)
+        end
+    end
+end
+return removed
+""")
+
+DAY_HOLDS_SCRIPT = async_redis_client.register_script("""
+return redis.call('ZRANGEBYSCORE', KEYS[1], '(' .. redis.call('TIME')[1], '+inf')
+""")
+
+RENEW_SLOT_LEASE_SCRIPT = async_redis_client.register_script("""
+local now = tonumber(redis.call('TIME')[1])
+local renewed = 0
+for _, key in ipairs(KEYS) do
+    for _, member in ipairs(redis.call('ZRANGEBYSCORE', key, '(' .. now, '+inf')) do
+        if string.sub(member, 1, #ARGV[1]) == ARGV[1] then
+            redis.call('ZADD', key, 'XX', now + tonumber(ARGV[2]), member)
+            renewed = renewed + 1
+        end
+    end
+    redis.call('EXPIRE', key, ARGV[3])
+end
+return renewed
+""")
+
+def day_holds_key(day_date):
+    return f"slot_holds:{day_date.isoformat()}"
+
+def lease_member_prefix(lease):
+    return f"{lease['slot']}|{lease['owner']}|"
+
+def lease_dates(lease):
+    return [datetime.strptime(key.split(":", 1)[1], "%Y-%m-%d").date() for key in lease["keys"]]
+
+def start_lease_renewal(context: ContextTypes.DEFAULT_TYPE, lease, attempt, first=SLOT_LEASE_RENEW_INTERVAL):
+    context.user_data["agendamento"]["lease"] = lease
+    context.user_data["agendamento"]["tentativa"] = attempt
+    context.job_queue.run_repeating(
+        renew_slot_lease, interval=SLOT_LEASE_RENEW_INTERVAL, first=first,
+        data=lease, name=f"lease:{lease['owner']}"
+    )
+
+async def get_day_holds(day_date, exclude_owner=None):
+    """Conta as reservas ativas por horário do dia (um único round trip), ignorando as de exclude_owner."""
     try:
-        reserved = redis_client.setnx(slot_key, "reserved")
-        if reserved:
-            redis_client.expire(slot_key, ttl_seconds)
-            logger.info(f"Slot {slot_key} reservado por {ttl_seconds} segundos")
-            return True
+        members = await DAY_HOLDS_SCRIPT(keys=[day_holds_key(day_date)])
+    except redis.RedisError as e:
+        logger.warning(f"Não foi possível ler as reservas de {day_date.isoformat()}: {e}")
+        return {}
+    holds = {}
+    for member in members:
+        slot_str, owner = member.decode().split("|")[:2]
+        if owner != exclude_owner:
+            holds[slot_str] = holds.get(slot_str, 0) + 1
+    return holds
+
+async def get_dates_availability(dates, slot_str, allow_stale=True):
+    """Vagas livres do horário em cada data, com uma única consulta de disponibilidade para todas elas."""
+    busy_info = await get_busy_info_async(min(dates), max(dates) + timedelta(days=1), allow_stale=allow_stale)
+    availability = {}
+    for day_date in dates:
+        remaining = 0
+        if SCHEDULE.is_open_slot(day_date, slot_str):
+            # Vagas que os agendamentos confirmados deixam livres; as reservas em andamento disputam só essas
+            remaining = min(
+                get_slot_remaining(busy_info, day_date, slot_str),
+                max(0, MAX_APPOINTMENTS_PER_DAY - get_day_total(busy_info, day_date)),
+            )
+        availability[day_date] = {
+            "remaining": remaining,
+            "capacity": get_slot_capacity(busy_info, day_date, SLOT_INDEX[slot_str]),
+            "stale": busy_info.get("stale", False),
+        }
+    return availability
+
+async def reserve_slot(update: Update, context: ContextTypes.DEFAULT_TYPE, dates, hour, seats=1):
+    """Reserva `seats` vagas do horário em todas as datas de uma vez.
+
+    Retorna (reservou, vagas restantes por data); se faltar vaga em alguma data nada é reservado e o
+    dicionário traz só a data que falhou. Uma reserva anterior do mesmo horário é ajustada sem ser perdida.
+    """
+    lease = context.user_data["agendamento"].get("lease")
+    if lease and lease["slot"] != hour:
+        await release_slot(context)
+        lease = None
+    availability = await get_dates_availability(dates, hour)
+    slot_keys = [day_holds_key(day_date) for day_date in dates]
+    attempt = uuid.uuid4().hex
+    owner = lease["owner"] if lease else f"{update.effective_user.id}:{attempt}"
+    try:
+        result = await ACQUIRE_SLOT_LEASE_SCRIPT(
+            keys=slot_keys,
+            args=[f"{hour}|", owner, seats, SLOT_LEASE_TTL, SLOT_LEASE_MAX_HOLD + SLOT_LEASE_TTL,
+                  *(availability[day_date]["remaining"] for day_date in dates)]
+        )
+    except redis.RedisError as e:
+        logger.error(f"Erro ao reservar slot {hour} em {slot_keys}: {str(e)}\n{traceback.format_exc()}")
+        return False, {}
+    if not result[0]:
+        failed_date = dates[result[1] - 1]
+        logger.info(f"Slot {failed_date.isoformat()} {hour} sem {seats} vaga(s) livre(s) (capacidade restante {availability[failed_date]['remaining']})")
+        return False, {failed_date: 0}
+    if lease:
+        dropped_keys = [key for key in lease["keys"] if key not in slot_keys]
+        if dropped_keys:
+            try:
+                await RELEASE_SLOT_LEASE_SCRIPT(keys=dropped_keys, args=[lease_member_prefix(lease)])
+                await publish_slot_freed(lease_dates({"keys": dropped_keys}), hour)
+            except redis.RedisError as e:
+                logger.warning(f"Não foi possível liberar as reservas de {dropped_keys}: {e}")
+        # O job de renovação recebe o mesmo dicionário, então passa a renovar as novas chaves
+        lease["keys"] = slot_keys
+        lease["seats"] = seats
+    else:
+        lease = {"keys": slot_keys, "slot": hour, "owner": owner, "seats": seats, "acquired_at": time.time()}
+        start_lease_renewal(context, lease, attempt)
+    remaining = dict(zip(dates, result[1:]))
+    logger.info(f"Slot {hour} reservado por {SLOT_LEASE_TTL} segundos: {seats} vaga(s) em {len(dates)} data(s)")
+    return True, remaining
+
+async def release_slot(context: ContextTypes.DEFAULT_TYPE, publish=True):
+    """Libera a reserva em andamento; publish=False quando as vagas foram convertidas em agendamento."""
+    lease = context.user_data.get("agendamento", {}).pop("lease", None)
+    if not lease:
+        return
+    for job in context.job_queue.get_jobs_by_name(f"lease:{lease['owner']}"):
+        job.schedule_removal()
+    try:
+        if await RELEASE_SLOT_LEASE_SCRIPT(keys=lease["keys"], args=[lease_member_prefix(lease)]):
+            logger.info(f"Vagas do horário {lease['slot']} liberadas em {lease['keys']}")
+            if publish:
+                await publish_slot_freed(lease_dates(lease), lease["slot"])
         else:
-            logger.info(f"Slot {slot_key} já reservado")
-            return False
+            logger.info(f"Reserva do horário {lease['slot']} em {lease['keys']} já havia expirado")
+    except redis.RedisError as e:
+        logger.error(f"Erro ao liberar slot {lease['keys']}: {str(e)}\n{traceback.format_exc()}")
+
+async def renew_slot_lease(context: ContextTypes.DEFAULT_TYPE):
+    lease = context.job.data
+    if time.time() - lease["acquired_at"] >= SLOT_LEASE_MAX_HOLD:
+        logger.info(f"Reserva {lease['keys']} atingiu o tempo máximo; deixando expirar")
+        context.job.schedule_removal()
+        # Avisa a lista de espera quando a reserva expirar de fato no Redis
+        context.job_queue.run_once(publish_expired_lease, when=SLOT_LEASE_TTL, data=lease)
+        return
+    try:
+        renewed = await RENEW_SLOT_LEASE_SCRIPT(
+            keys=lease["keys"], args=[lease_member_prefix(lease), SLOT_LEASE_TTL, SLOT_LEASE_MAX_HOLD + SLOT_LEASE_TTL]
+        )
+    except redis.RedisError as e:
+        logger.warning(f"Não foi possível renovar a reserva {lease['keys']}: {e}")
+        return
+    if renewed < lease["seats"] * len(lease["keys"]):
+        logger.warning(f"Reserva {lease['keys']} perdida antes da renovação")
+        context.job.schedule_removal()
+
+# --- LISTA DE ESPERA ---
+# Cancelamentos e reservas liberadas publicam "vaga liberada" no Redis; cada worker acumula os eventos e o
+# job notify_waitlist oferece a vaga ao próximo da fila com uma reserva temporária, respeitando um limite
+# de mensagens por execução. Assim o usuário não precisa reabrir o calendário até achar uma vaga.
+def waitlist_offer_key(token):
+    return f"waitlist_offer:{token}"
+
+def handle_slot_freed_message(message):
+    try:
+        payload = json.loads(message["data"])
+        freed = [(datetime.strptime(day_str, "%Y-%m-%d").date(), payload["horario"]) for day_str in payload["dates"]]
+    except (TypeError, ValueError, KeyError):
+        logger.warning(f"Mensagem de vaga liberada inválida: {message.get('data')}")
+        return
+    with freed_lock:
+        freed_slots.update(freed)
+
+def start_slot_freed_listener():
+    try:
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{SLOT_FREED_CHANNEL: handle_slot_freed_message})
+        pubsub.run_in_thread(sleep_time=1, daemon=True)
+        logger.info("Ouvindo vagas liberadas para a lista de espera")
+    except redis.RedisError as e:
+        logger.warning(f"Redis indisponível, lista de espera atendida apenas pelos eventos locais: {e}")
+
+async def publish_slot_freed(dates, slot_str):
+    try:
+        await async_redis_client.publish(SLOT_FREED_CHANNEL, json.dumps({
+            "origin": WORKER_ID,
+            "dates": [day_date.isoformat() for day_date in dates],
+            "horario": slot_str,
+        }))
+    except redis.RedisError as e:
+        logger.warning(f"Não foi possível publicar a vaga liberada: {e}")
+        with freed_lock:
+            freed_slots.update((day_date, slot_str) for day_date in dates)
+
+async def publish_cancelled_events(events):
+    freed = {}
+    for event in events:
+        event_start = get_event_start(event)
+        if event_start:
+            freed.setdefault(event_start.strftime("%H:%M"), []).append(event_start.date())
+    for slot_str, dates in freed.items():
+        await publish_slot_freed(dates, slot_str)
+
+async def publish_expired_lease(context: ContextTypes.DEFAULT_TYPE):
+    lease = context.job.data
+    await publish_slot_freed(lease_dates(lease), lease["slot"])
+
+async def subscribe_waitlist(update: Update, context: ContextTypes.DEFAULT_TYPE, year, month, day, hour=None):
+    try:
+        agendamento = context.user_data.get("agendamento", {})
+        if "nome" not in agendamento or "telefone" not in agendamento:
+            await send_error_message(update, context, "estado de agendamento perdido")
+            return
+        selected_date = datetime(year, month, day).date()
+        slot_str = f"{hour[:2]}:{hour[2:]}" if hour else None
+        if selected_date < datetime.now().date() or (slot_str and not SCHEDULE.is_open_slot(selected_date, slot_str)):
+            await send_error_message(update, context, "ao entrar na lista de espera")
+            return
+        created = await run_ledger(
+            add_waitlist_entry, update.effective_user.id, update.effective_chat.id,
+            agendamento["nome"], agendamento["telefone"], selected_date, slot_str
+        )
+        target = f"{day}/{month}/{year}" + (f" às {slot_str}" if slot_str else "")
+        message = (
+            f"🔔 **Você está na lista de espera de {target}.**\n"
+            "Avisaremos aqui assim que uma vaga for liberada e ela ficará reservada para você por "
+            f"{WAITLIST_OFFER_TTL // 60} minutos."
+        ) if created else f"🔔 Você já está na lista de espera de {target}."
+        await update.callback_query.message.edit_text(
+            message,
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Voltar ao Calendário", callback_data="cal_back")],
+                [InlineKeyboardButton("🔙 Voltar ao Menu", callback_data="main_menu")]
+            ]),
+            parse_mode="Markdown",
+        )
+        logger.info(f"Usuário {update.effective_user.id} na lista de espera de {selected_date.isoformat()} {slot_str or 'dia inteiro'}")
     except Exception as e:
-        logger.error(f"Erro ao reservar slot {slot_key}: {str(e)}\n{traceback.format_exc()}")
-        return False
+        logger.error(f"Erro em subscribe_waitlist: {str(e)}\n{traceback.format_exc()}")
+        await send_error_message(update, context, "ao entrar na lista de espera")
+
+RELEASE_WAITLIST_LOCK_SCRIPT = async_redis_client.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+def waitlist_slot_lock_key(day_date, slot_str):
+    return f"waitlist:lock:{day_date.isoformat()}:{slot_str}"
+
+async def offer_freed_slot(context: ContextTypes.DEFAULT_TYPE, day_date, slot_str, limit):
+    """Oferece as vagas livres do horário aos próximos da fila; retorna quantas mensagens foram enviadas.
+
+    Todos os workers recebem cada vaga liberada; só quem obtém a trava do (data, horário) a atende.
+    Retorna None se outro worker está atendendo o horário agora.
+    """
+    lock_key = waitlist_slot_lock_key(day_date, slot_str)
+    if not await async_redis_client.set(lock_key, WORKER_ID, nx=True, ex=60):
+        return None
+    try:
+        return await offer_locked_slot(context, day_date, slot_str, limit)
+    finally:
+        await RELEASE_WAITLIST_LOCK_SCRIPT(keys=[lock_key], args=[WORKER_ID])
+
+async def offer_locked_slot(context: ContextTypes.DEFAULT_TYPE, day_date, slot_str, limit):
+    availability = await get_dates_availability([day_date], slot_str)
+    holds = await get_day_holds(day_date)
+    capacity = availability[day_date]["remaining"]
+    free = capacity - holds.get(slot_str, 0)
+    sent = 0
+    while free > 0 and sent < limit:
+        entry = await run_ledger(claim_waitlist_entry, day_date, slot_str)
+        if not entry:
+            break
+        entry_id, user_id, chat_id, nome, telefone, offered_at, offered_slot = entry
+        attempt = uuid.uuid4().hex
+        owner = f"{user_id}:{attempt}"
+        try:
+            reserved, _ = await ACQUIRE_SLOT_LEASE_SCRIPT(
+                keys=[day_holds_key(day_date)],
+                args=[f"{slot_str}|", owner, 1, WAITLIST_OFFER_TTL, WAITLIST_OFFER_TTL + SLOT_LEASE_TTL, capacity]
+            )
+        except redis.RedisError as e:
+            logger.warning(f"Não foi possível reservar {day_date.isoformat()} {slot_str} para a lista de espera: {e}")
+            reserved = False
+        if not reserved:
+            # Outro usuário levou a vaga entre a leitura e a reserva: o inscrito volta sem perder a posição
+            await run_ledger(unclaim_waitlist_entry, entry_id, offered_at, offered_slot)
+            break
+        token = uuid.uuid4().hex[:16]
+        offer = {
+            "entry_id": entry_id, "user_id": user_id, "owner": owner, "data": day_date.isoformat(),
+            "horario": slot_str, "nome": nome, "telefone": telefone, "restantes": free - 1,
+            "expira_em": time.time() + WAITLIST_OFFER_TTL,
+        }
+        # A chave vive mais que o prazo da oferta para que expire_waitlist_offer ainda a encontre e
+        # passe a vaga adiante; o prazo em si é verificado por expira_em
+        await async_redis_client.set(waitlist_offer_key(token), json.dumps(offer), ex=2 * WAITLIST_OFFER_TTL)
+        try:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=f"🔔 **Vagou um horário!**\n\n📅 {day_date.strftime('%d/%m/%Y')} às {slot_str}\n"
+                     f"Ele está reservado para você por {WAITLIST_OFFER_TTL // 60} minutos.",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("✅ Quero este horário", callback_data=f"cal_offer_{token}")],
+                    [InlineKeyboardButton("❌ Não quero", callback_data=f"cal_decline_{token}")]
+                ]),
+                parse_mode="Markdown",
+            )
+        except Exception as e:
+            logger.warning(f"Não foi possível avisar o usuário {user_id} da lista de espera: {e}")
+            await async_redis_client.delete(waitlist_offer_key(token))
+            await RELEASE_SLOT_LEASE_SCRIPT(keys=[day_holds_key(day_date)], args=[f"{slot_str}|{owner}|"])
+            await run_ledger(update_waitlist_entry, entry_id, "cancelado")
+            continue
+        context.job_queue.run_once(
+            expire_waitlist_offer, when=WAITLIST_OFFER_TTL, data={"token": token}, name=f"oferta:{token}"
+        )
+        logger.info(f"Vaga {day_date.isoformat()} {slot_str} oferecida ao usuário {user_id} da lista de espera")
+        free -= 1
+        sent += 1
+    return sent
 
-def release_slot(year, month, day, hour):
-    slot_key = f"slot:{year}:{month}:{day}:{hour}"
+async def notify_waitlist(context: ContextTypes.DEFAULT_TYPE):
+    with freed_lock:
+        pending = sorted(freed_slots)
+        freed_slots.clear()
+    now = datetime.now()
+    sent = 0
+    for index, (day_date, slot_str) in enumerate(pending):
+        if sent >= WAITLIST_NOTIFY_RATE:
+            # Limite de mensagens atingido; o restante fica para a próxima execução
+            with freed_lock:
+                freed_slots.update(pending[index:])
+            break
+        if slot_str not in SLOT_INDEX or datetime.combine(day_date, SLOT_TIMES[SLOT_INDEX[slot_str]]) < now:
+            continue
+        try:
+            offered = await offer_freed_slot(context, day_date, slot_str, WAITLIST_NOTIFY_RATE - sent)
+            if offered is None:
+                # Outro worker está atendendo o horário; confere de novo na próxima execução
+                with freed_lock:
+                    freed_slots.add((day_date, slot_str))
+                continue
+            sent += offered
+        except (CalendarUnavailableError, redis.RedisError, sqlite3.Error) as e:
+            logger.warning(f"Lista de espera adiada para a próxima execução: {e}")
+            with freed_lock:
+                freed_slots.update(pending[index:])
+            break
+
+async def pop_waitlist_offer(token, user_id=None):
+    """Consome a oferta uma única vez; None se expirou, já foi usada ou pertence a outro usuário."""
+    raw = await async_redis_client.get(waitlist_offer_key(token))
+    if not raw:
+        return None
+    offer = json.loads(raw)
+    if user_id is not None and offer["user_id"] != user_id:
+        return None
+    # DEL decide a disputa entre aceitar, recusar e expirar
+    if not await async_redis_client.delete(waitlist_offer_key(token)):
+        return None
+    return offer
+
+async def accept_waitlist_offer(update: Update, context: ContextTypes.DEFAULT_TYPE, token):
     try:
-        redis_client.delete(slot_key)
-        logger.info(f"Slot {slot_key} liberado")
+        offer = await pop_waitlist_offer(token, update.effective_user.id)
+        if offer:
+            for job in context.job_queue.get_jobs_by_name(f"oferta:{token}"):
+                job.schedule_removal()
+            if time.time() >= offer["expira_em"]:
+                await close_waitlist_offer(offer, "expirado")
+                offer = None
+        if not offer:
+            await update.callback_query.message.edit_text(
+                "⌛ Esta oferta expirou ou já foi usada.",
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Voltar ao Menu", callback_data="main_menu")]]),
+            )
+            return
+        await clear_scheduling_state(context)
+        day_date = datetime.fromisoformat(offer["data"]).date()
+        data_str = f"{day_date.day}/{day_date.month}/{day_date.year}"
+        context.user_data["agendamento"] = {
+            "etapa": "email", "nome": offer["nome"], "telefone": offer["telefone"], "data": data_str,
+            "horario": f"{data_str} {offer['horario']}", "vagas": 1, "ocorrencias": [offer["data"]],
+            "restantes": offer["restantes"],
+        }
+        # A reserva feita pelo notificador passa a ser a reserva do agendamento; renova já, porque só
+        # resta a ela o que sobrou de WAITLIST_OFFER_TTL
+        lease = {"keys": [day_holds_key(day_date)], "slot": offer["horario"], "owner": offer["owner"], "seats": 1, "acquired_at": time.time()}
+        start_lease_renewal(context, lease, offer["owner"].split(":", 1)[1], first=0)
+        touch_scheduling(update, context)
+        # A inscrição só é dada como atendida quando o agendamento for gravado (settle_waitlist_entry)
+        context.user_data["agendamento"]["lista_espera"] = {"id": offer["entry_id"], "data": offer["data"]}
+        await run_ledger(update_waitlist_entry, offer["entry_id"], "reservado")
+        text, keyboard = build_booking_options_prompt(context.user_data["agendamento"])
+        await update.callback_query.message.edit_text(text, reply_markup=keyboard, parse_mode="Markdown")
+        logger.info(f"Oferta da lista de espera aceita: {offer['data']} {offer['horario']}")
     except Exception as e:
-        logger.error(f"Erro ao liberar slot {slot_key}: {str(e)}\n{traceback.format_exc()}")
+        logger.error(f"Erro em accept_waitlist_offer: {str(e)}\n{traceback.format_exc()}")
+        await send_error_message(update, context, "ao aceitar a vaga liberada")
+
+async def settle_waitlist_entry(agendamento, booked_dates=()):
+    """Encerra a inscrição que originou o agendamento: 'aceito' se a data foi agendada, senão volta para a fila."""
+    entry = agendamento.pop("lista_espera", None)
+    if not entry:
+        return
+    if datetime.fromisoformat(entry["data"]).date() in booked_dates:
+        await run_ledger(update_waitlist_entry, entry["id"], "aceito")
+    else:
+        await run_ledger(requeue_waitlist_entry, entry["id"])
+
+async def sweep_waitlist_offers(context: ContextTypes.DEFAULT_TYPE):
+    now = datetime.now(timezone.utc)
+    try:
+        freed = await run_ledger(
+            release_stale_waitlist_offers,
+            now - timedelta(seconds=2 * WAITLIST_OFFER_TTL),
+            now - timedelta(seconds=WAITLIST_OFFER_TTL + SLOT_LEASE_MAX_HOLD + SCHEDULING_INACTIVITY_TIMEOUT),
+        )
+    except sqlite3.Error as e:
+        logger.error(f"Erro ao revisar ofertas da lista de espera: {str(e)}\n{traceback.format_exc()}")
+        return
+    for data, horario in freed:
+        await publish_slot_freed([datetime.strptime(data, "%Y-%m-%d").date()], horario)
+    if freed:
+        logger.info(f"{len(freed)} oferta(s) abandonada(s) da lista de espera devolvida(s) à fila")
+
+async def close_waitlist_offer(offer, status):
+    day_date = datetime.fromisoformat(offer["data"]).date()
+    try:
+        await RELEASE_SLOT_LEASE_SCRIPT(keys=[day_holds_key(day_date)], args=[f"{offer['horario']}|{offer['owner']}|"])
+    except redis.RedisError as e:
+        logger.warning(f"Não foi possível liberar a reserva da oferta: {e}")
+    await run_ledger(update_waitlist_entry, offer["entry_id"], status)
+    await publish_slot_freed([day_date], offer["horario"])
+
+async def decline_waitlist_offer(update: Update, context: ContextTypes.DEFAULT_TYPE, token):
+    try:
+        offer = await pop_waitlist_offer(token, update.effective_user.id)
+        if offer:
+            for job in context.job_queue.get_jobs_by_name(f"oferta:{token}"):
+                job.schedule_removal()
+            await close_waitlist_offer(offer, "recusado")
+        await update.callback_query.message.edit_text(
+            "👍 Tudo bem, o horário foi liberado para a próxima pessoa da lista de espera.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Voltar ao Menu", callback_data="main_menu")]]),
+        )
+    except Exception as e:
+        logger.error(f"Erro em decline_waitlist_offer: {str(e)}\n{traceback.format_exc()}")
+        await send_error_message(update, context, "ao recusar a vaga liberada")
+
+async def expire_waitlist_offer(context: ContextTypes.DEFAULT_TYPE):
+    offer = await pop_waitlist_offer(context.job.data["token"])
+    if offer:
+        logger.info(f"Oferta da lista de espera para {offer['data']} {offer['horario']} expirou sem resposta")
+        await close_waitlist_offer(offer, "expirado")
+
+def build_appointment_event(nome, telefone, email, start_time, event_id=None):
+    end_time = start_time + timedelta(minutes=APPOINTMENT_DURATION_MINUTES)
+    event = {
+        "summary": f"Atendimento - {nome}",
+        "description": f"Nome: {nome}\nTelefone: {telefone}\nE-mail: {email.lower()}",
+        "start": {"dateTime": start_time.isoformat(), "timeZone": "America/Sao_Paulo"},
+        "end": {"dateTime": end_time.isoformat(), "timeZone": "America/Sao_Paulo"},
+    }
+    if event_id:
+        event["id"] = event_id
+    return event
 
 async def confirm_appointment(update: Update, context: ContextTypes.DEFAULT_TYPE, year, month, day, hour):
     try:
         agendamento = context.user_data.get("agendamento", {})
+        hora_formatada = f"{hour[:2]}:{hour[2:]}"
+        horario = f"{day}/{month}/{year} {hora_formatada}"
+        if not agendamento and context.user_data.get("ultimo_agendamento", {}).get("horario") == horario:
+            logger.info(f"Repetição ignorada: agendamento de {horario} já confirmado")
+            return
         if not agendamento or "etapa" not in agendamento:
             await send_error_message(update, context, "estado de agendamento perdido")
             return
-        hora_formatada = f"{hour[:2]}:{hour[2:]}"
+        if agendamento.get("confirmando") or (
+            update.callback_query and agendamento.get("etapa") in ("email", "confirmacao") and agendamento.get("horario") == horario
+        ):
+            logger.info(f"Repetição ignorada durante o agendamento de {horario}")
+            return
         if agendamento.get("etapa") == "horario":
-            if not reserve_slot(year, month, day, hora_formatada):
+            if not SCHEDULE.is_open_slot(datetime(year, month, day).date(), hora_formatada):
+                logger.warning(f"Horário fora do expediente solicitado: {day}/{month}/{year} {hora_formatada}")
+                await send_error_message(update, context, "horário fora do expediente")
+                return
+            selected_date = datetime(year, month, day).date()
+            reserved, remaining_seats = await reserve_slot(update, context, [selected_date], hora_formatada)
+            if not reserved:
                 await update.callback_query.message.edit_text(
-                    f"❌ **Horário {hora_formatada} em {day}/{month}/{year} foi reservado por outro usuário.**\nEscolha outro horário:",
+                    f"❌ **Não há vagas livres em {day}/{month}/{year} às {hora_formatada} no momento.**\nEscolha outro horário:",
                     reply_markup=InlineKeyboardMarkup([
                         [InlineKeyboardButton("🔙 Voltar ao Calendário", callback_data="cal_back")],
                         [InlineKeyboardButton("🔙 Voltar ao Menu", callback_data="main_menu")]
@@ -567,27 +2870,52 @@ async def confirm_appointment(update: Update, context: ContextTypes.DEFAULT_TYPE
                 return
             context.user_data["agendamento"]["etapa"] = "email"
             context.user_data["agendamento"]["horario"] = f"{day}/{month}/{year} {hora_formatada}"
-            await update.callback_query.message.edit_text(
-                "📧 Por favor, digite seu e-mail para confirmação:",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Voltar ao Menu", callback_data="main_menu")]]),
-                parse_mode="Markdown"
-            )
+            context.user_data["agendamento"]["vagas"] = 1
+            context.user_data["agendamento"]["ocorrencias"] = [selected_date.isoformat()]
+            context.user_data["agendamento"]["restantes"] = remaining_seats[selected_date]
+            text, keyboard = build_booking_options_prompt(context.user_data["agendamento"])
+            await update.callback_query.message.edit_text(text, reply_markup=keyboard, parse_mode="Markdown")
             logger.info(f"Agendamento - Etapa: email")
             return
         if agendamento.get("etapa") != "confirmacao":
-            release_slot(year, month, day, hora_formatada)
+            await release_slot(context)
             await send_error_message(update, context, f"etapa de agendamento inválida")
             return
         if "email" not in agendamento:
-            release_slot(year, month, day, hora_formatada)
+            await release_slot(context)
             await send_error_message(update, context, "e-mail não fornecido")
             return
-        selected_date = datetime(year, month, day).date()
-        busy_info_check = get_busy_info(selected_date, selected_date + timedelta(days=1))
-        if hora_formatada in busy_info_check["hourly"].get(day, []) or busy_info_check["total"].get(day, 0) >= MAX_APPOINTMENTS_PER_DAY:
-            release_slot(year, month, day, hora_formatada)
+        # Marca a confirmação em andamento para ignorar toques/mensagens repetidos até o commit no livro local
+        agendamento["confirmando"] = True
+        try:
+            dates = [datetime.fromisoformat(iso).date() for iso in agendamento.get("ocorrencias", [datetime(year, month, day).date().isoformat()])]
+            seats = agendamento.get("vagas", 1)
+            attempt = agendamento.get("tentativa")
+            idempotency_keys = [
+                booking_idempotency_key(update.effective_user.id, day_date, hora_formatada, attempt if seat == 0 else f"{attempt}:{seat}")
+                for day_date in dates for seat in range(seats)
+            ]
+            # Uma repetição já gravada não passa pela verificação de vagas: os próprios agendamentos
+            # pendentes do usuário contam como ocupados e a fariam parecer indisponível
+            booking_ids = await run_ledger(find_bookings_by_keys, idempotency_keys) or None
+            created, unavailable = False, []
+            if not booking_ids:
+                # Uma única verificação (sem dados defasados) cobre todas as ocorrências antes do commit
+                availability = await get_dates_availability(dates, hora_formatada, allow_stale=False)
+                unavailable = [day_date for day_date in dates if availability[day_date]["remaining"] < seats]
+            if not booking_ids and not unavailable:
+                booking_ids, created = await run_ledger(
+                    commit_bookings, agendamento['nome'], agendamento['telefone'], agendamento['email'].lower(),
+                    hora_formatada, [(day_date, availability[day_date]["capacity"]) for day_date in dates], seats,
+                    idempotency_keys
+                )
+        finally:
+            agendamento.pop("confirmando", None)
+        await release_slot(context, publish=booking_ids is None)
+        if booking_ids is None:
+            failed_date = unavailable[0] if unavailable else dates[0]
             await update.effective_message.reply_text(
-                f"❌ **Horário {hora_formatada} em {day}/{month}/{year} não está mais disponível.**\nEscolha outro horário:",
+                f"❌ **Horário {hora_formatada} em {failed_date.strftime('%d/%m/%Y')} não está mais disponível.**\nEscolha outro horário:",
                 reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("🔙 Voltar ao Calendário", callback_data="cal_back")],
                     [InlineKeyboardButton("🔙 Voltar ao Menu", callback_data="main_menu")]
@@ -595,32 +2923,37 @@ async def confirm_appointment(update: Update, context: ContextTypes.DEFAULT_TYPE
                 parse_mode="Markdown",
             )
             return
-        start_time = datetime(year, month, day, int(hour[:2]), int(hour[2:]))
-        end_time = start_time + timedelta(minutes=APPOINTMENT_DURATION_MINUTES)
-        service = get_calendar_service()
-        if not service:
-            release_slot(year, month, day, hora_formatada)
-            raise Exception("Serviço do Google Calendar não disponível")
-        event = {
-            "summary": f"Atendimento - {agendamento['nome']}",
-            "description": f"Nome: {agendamento['nome']}\nTelefone: {agendamento['telefone']}\nE-mail: {agendamento['email'].lower()}",
-            "start": {"dateTime": start_time.isoformat(), "timeZone": "America/Sao_Paulo"},
-            "end": {"dateTime": end_time.isoformat(), "timeZone": "America/Sao_Paulo"},
-        }
-        created_event = service.events().insert(calendarId=CALENDAR_ID, body=event).execute()
-        logger.info(f"Evento criado: {created_event.get('htmlLink')}")
-        release_slot(year, month, day, hora_formatada)
+        context.user_data["ultimo_agendamento"] = {"horario": horario, "id": booking_ids}
+        await settle_waitlist_entry(agendamento, dates)
         context.user_data["last_email"] = agendamento['email'].lower()
         email_sent = True
-        try:
-            send_confirmation_email(agendamento['email'], agendamento['nome'], f"{day}/{month}/{year} às {hora_formatada}")
-        except Exception as e:
-            logger.error(f"Erro ao enviar e-mail: {str(e)}\n{traceback.format_exc()}")
-            email_sent = False
+        if created:
+            logger.info(f"Agendamentos {booking_ids} registrados no livro local ({seats} vaga(s) em {len(dates)} data(s))")
+            context.job_queue.run_once(sync_pending_bookings, when=0)
+            hour_value, minute_value = map(int, hora_formatada.split(":"))
+            appointments = [
+                (datetime(day_date.year, day_date.month, day_date.day, hour_value, minute_value), idempotency_keys[i * seats])
+                for i, day_date in enumerate(dates)
+            ]
+            try:
+                await run_email(send_confirmation_email, agendamento['email'], agendamento['nome'], appointments, seats)
+            except Exception as e:
+                logger.error(f"Erro ao enviar e-mail: {str(e)}\n{traceback.format_exc()}")
+                email_sent = False
+        else:
+            # Repetição de uma confirmação já gravada: reenvia a mensagem, mas não o e-mail
+            logger.info(f"Agendamentos {booking_ids} já registrados para a tentativa {agendamento.get('tentativa')}")
+        if len(dates) == 1:
+            date_lines = f"📅 Data: {day}/{month}/{year} às {hora_formatada}\n"
+        else:
+            date_lines = f"📅 Datas ({len(dates)} semanas, às {hora_formatada}):\n" + "".join(
+                f"   • {day_date.strftime('%d/%m/%Y')}\n" for day_date in dates
+            )
         confirmation_msg = (
             f"✅ **Agendamento Confirmado!**\n\n"
-            f"📅 Data: {day}/{month}/{year} às {hora_formatada}\n"
-            f"👤 Nome: {agendamento['nome']}\n"
+            f"{date_lines}"
+            + (f"👥 Vagas por atendimento: {seats}\n" if seats > 1 else "")
+            + f"👤 Nome: {agendamento['nome']}\n"
             f"📞 Telefone: {agendamento['telefone']}\n"
             f"📧 E-mail: {agendamento['email']}\n\n"
         )
@@ -631,43 +2964,115 @@ async def confirm_appointment(update: Update, context: ContextTypes.DEFAULT_TYPE
             reply_markup=get_main_menu(),
             parse_mode="Markdown"
         )
-        context.user_data.pop("agendamento", None)
+        await clear_scheduling_state(context)
         logger.info("Agendamento concluído")
     except Exception as e:
         logger.error(f"Erro em confirm_appointment: {str(e)}\n{traceback.format_exc()}")
-        release_slot(year, month, day, hora_formatada)
+        await release_slot(context)
         await send_error_message(update, context, "ao confirmar o agendamento")
-        context.user_data.pop("agendamento", None)
+        await clear_scheduling_state(context)
+
+def build_booking_options_prompt(agendamento, warning=None):
+    seats = agendamento.get("vagas", 1)
+    occurrences = agendamento.get("ocorrencias", [])
+    text = warning + "\n\n" if warning else ""
+    if seats == 1 and len(occurrences) == 1:
+        text += f"⏳ Vaga reservada por {SLOT_LEASE_TTL // 60} minutos (restam {agendamento.get('restantes', 0)} vaga(s) neste horário).\n\n"
+    else:
+        text += (
+            f"⏳ {seats} vaga(s) reservada(s) em {len(occurrences)} data(s) por {SLOT_LEASE_TTL // 60} minutos "
+            f"(restam ao menos {agendamento.get('restantes', 0)} vaga(s) em cada data).\n"
+        )
+        if len(occurrences) > 1:
+            text += "🔁 " + ", ".join(datetime.fromisoformat(iso).strftime("%d/%m") for iso in occurrences) + "\n"
+        text += "\n"
+    text += "👥 Vagas (família/grupo) e 🔁 semanas podem ser ajustadas abaixo.\n📧 Por favor, digite seu e-mail para confirmação:"
+    keyboard = []
+    if GROUP_MAX_SEATS > 1:
+        keyboard.append([
+            InlineKeyboardButton(f"{'✅' if n == seats else '👥'} {n}", callback_data=f"cal_seats_{n}")
+            for n in range(1, GROUP_MAX_SEATS + 1)
+        ])
+    if len(RECURRING_WEEK_OPTIONS) > 1:
+        keyboard.append([
+            InlineKeyboardButton(f"{'✅' if weeks == len(occurrences) else '🔁'} {weeks}x", callback_data=f"cal_weeks_{weeks}")
+            for weeks in RECURRING_WEEK_OPTIONS
+        ])
+    keyboard.append([InlineKeyboardButton("🔙 Voltar ao Menu", callback_data="main_menu")])
+    return text, InlineKeyboardMarkup(keyboard)
+
+async def update_booking_options(update: Update, context: ContextTypes.DEFAULT_TYPE, seats=None, weeks=None):
+    """Ajusta o número de vagas e de semanas da reserva em andamento, reservando tudo de novo de uma vez."""
+    try:
+        agendamento = context.user_data.get("agendamento", {})
+        if agendamento.get("etapa") != "email" or "horario" not in agendamento:
+            await send_error_message(update, context, "estado de agendamento perdido")
+            return
+        seats = seats or agendamento.get("vagas", 1)
+        weeks = weeks or len(agendamento.get("ocorrencias", [])) or 1
+        if not 1 <= seats <= GROUP_MAX_SEATS or weeks not in RECURRING_WEEK_OPTIONS + [1]:
+            logger.warning(f"Opção de agendamento inválida: {seats} vaga(s), {weeks} semana(s)")
+            return
+        data_str, hora_formatada = agendamento["horario"].split()
+        day, month, year = map(int, data_str.split("/"))
+        first_date = datetime(year, month, day).date()
+        dates = [first_date + timedelta(weeks=week) for week in range(weeks)]
+        reserved, remaining_seats = await reserve_slot(update, context, dates, hora_formatada, seats)
+        warning = None
+        if reserved:
+            agendamento["vagas"] = seats
+            agendamento["ocorrencias"] = [day_date.isoformat() for day_date in dates]
+            agendamento["restantes"] = min(remaining_seats.values())
+        elif remaining_seats:
+            failed_date = next(iter(remaining_seats))
+            warning = f"❌ Não há {seats} vaga(s) livre(s) em {failed_date.strftime('%d/%m/%Y')} às {hora_formatada}; a reserva anterior foi mantida."
+        else:
+            warning = "❌ Não foi possível ajustar a reserva agora; a reserva anterior foi mantida."
+        text, keyboard = build_booking_options_prompt(agendamento, warning)
+        await update.callback_query.message.edit_text(text, reply_markup=keyboard, parse_mode="Markdown")
+        logger.info(f"Agendamento - Opções: {agendamento.get('vagas', 1)} vaga(s), {len(agendamento.get('ocorrencias', []))} semana(s)")
+    except Exception as e:
+        logger.error(f"Erro em update_booking_options: {str(e)}\n{traceback.format_exc()}")
+        await send_error_message(update, context, "ao ajustar as opções do agendamento")
+
+# O SMTP tem executor próprio: um servidor de e-mail lento não ocupa as threads do livro de agendamentos
+email_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="email")
 
-def send_confirmation_email(to_email, name, appointment_time):
+async def run_email(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(email_executor, functools.partial(func, *args, **kwargs))
+
+def send_confirmation_email(to_email, name, appointments, seats=1):
+    """Envia um único e-mail com um convite .ics contendo um VEVENT por data agendada.
+
+    appointments é uma lista de (início, uid); o uid é o id do evento no Google Calendar.
+    """
     try:
         msg = MIMEMultipart()
         msg['From'] = EMAIL_USER
         msg['To'] = to_email
         msg['Subject'] = "✅ Confirmação de Agendamento"
+        appointment_times = "<br>".join(start_time.strftime("%d/%m/%Y às %H:%M") for start_time, _ in appointments)
+        seats_line = f"<p><strong>Vagas por atendimento:</strong> {seats}</p>" if seats > 1 else ""
         body = f"""
         <h2>Seu agendamento foi confirmado!</h2>
         <p><strong>Nome:</strong> {name}</p>
-        <p><strong>Data/Horário:</strong> {appointment_time}</p>
+        <p><strong>Data/Horário:</strong> {appointment_times}</p>
+        {seats_line}
         <p>Por favor, se prepare com 15 minutos de antecedência, <br>procure relaxar e, <strong>(CALMAMENTE)</strong> inspire o ar pelo nariz e, expire pelo nariz, pelo menos 3 vezes.</p>
         <p>Segue em anexo o convite do evento (.ics) para adicionar ao seu calendário.</p>
         <p>Agradecemos sua confiança!</p>
         """
         msg.attach(MIMEText(body, 'html'))
-        date_part, time_part = appointment_time.split(" às ")
-        day, month, year = map(int, date_part.split("/"))
-        hour, minute = map(int, time_part.split(":"))
-        start_time = datetime(year, month, day, hour, minute)
-        end_time = start_time + timedelta(minutes=APPOINTMENT_DURATION_MINUTES)
-        dtstart = start_time.strftime("%Y%m%dT%H%M%SZ")
-        dtend = end_time.strftime("%Y%m%dT%H%M%SZ")
         safe_name = name.encode('ascii', 'ignore').decode('ascii').replace(' ', '_')
         safe_email_user = EMAIL_USER.encode('ascii', 'ignore').decode('ascii')
-        ics_content = f"""BEGIN:VCALENDAR
-VERSION:2.0
-PRODID:-//xAI//Grok Bot//EN
-BEGIN:VEVENT
-UID:{datetime.now().strftime('%Y%m%d%H%M%S')}-{safe_name}@xai.com
+        events = []
+        for start_time, uid in appointments:
+            end_time = start_time + timedelta(minutes=APPOINTMENT_DURATION_MINUTES)
+            dtstart = start_time.strftime("%Y%m%dT%H%M%SZ")
+            dtend = end_time.strftime("%Y%m%dT%H%M%SZ")
+            events.append(f"""BEGIN:VEVENT
+UID:{uid}-{safe_name}@xai.com
 DTSTART:{dtstart}
 DTEND:{dtend}
 SUMMARY:Atendimento - {safe_name}
@@ -675,7 +3080,11 @@ DESCRIPTION:Por favor, se prepare com 15 minutos de antecedência, <br>procure r
 ORGANIZER;CN={safe_email_user}:MAILTO:{safe_email_user}
 LOCATION:CSOMN - Casa Socorrista e Orfanato Maria de Nazaré
 END:VEVENT
-END:VCALENDAR
+""")
+        ics_content = f"""BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//xAI//Grok Bot//EN
+{"".join(events)}END:VCALENDAR
 """
         ics_part = MIMEApplication(ics_content.encode('utf-8'), _subtype="calendar; charset=utf-8")
         ics_part.add_header('Content-Disposition', 'attachment; filename="invite.ics"')
@@ -686,7 +3095,7 @@ END:VCALENDAR
             server.ehlo()
             server.login(EMAIL_USER, EMAIL_PASSWORD)
             server.send_message(msg)
-            logger.info(f"E-mail enviado para {to_email}")
+            logger.info(f"E-mail enviado para {to_email} com {len(appointments)} evento(s)")
     except Exception as e:
         logger.error(f"Erro ao enviar e-mail para {to_email}: {str(e)}\n{traceback.format_exc()}")
         raise
@@ -829,40 +3238,16 @@ async def handle_cancel_appointment(update: Update, context: ContextTypes.DEFAUL
         context.user_data.pop("cancelamento", None)
 
 def get_user_events(email, date=None, page=0, page_size=5):
-    try:
-        service = get_calendar_service()
-        if not service:
-            logger.warning("Serviço do Google Calendar não disponível")
-            return [], 0
-        now = datetime.now()
-        end_date = now + timedelta(days=365)
-        if date:
-            start_date = datetime.strptime(date, '%Y-%m-%d').date()
-            end_date = start_date + timedelta(days=1)
-            time_min = datetime.combine(start_date, datetime.min.time()).isoformat() + "Z"
-            time_max = datetime.combine(end_date, datetime.min.time()).isoformat() + "Z"
-        else:
-            time_min = now.isoformat() + "Z"
-            time_max = end_date.isoformat() + "Z"
-        events_result = service.events().list(
-            calendarId=CALENDAR_ID,
-            timeMin=time_min,
-            timeMax=time_max,
-            singleEvents=True,
-            orderBy="startTime",
-            q=email
-        ).execute()
-        user_events = [
-            event for event in events_result.get("items", [])
-            if 'description' in event and email in event['description'].lower()
-            and 'start' in event and 'dateTime' in event['start']
-        ]
-        start_idx = page * page_size
-        end_idx = start_idx + page_size
-        return user_events[start_idx:end_idx], len(user_events)
-    except Exception as e:
-        logger.error(f"Erro em get_user_events: {str(e)}\n{traceback.format_exc()}")
-        return [], 0
+    # Consulta só o índice local, sem chamar o Google: continua funcionando durante uma queda do Calendar.
+    # O índice é mantido pelas escritas do bot, pelas sincronizações do espelho e por reconcile_event_index.
+    if date:
+        start_date = datetime.strptime(date, '%Y-%m-%d')
+        time_min = start_date.astimezone(timezone.utc).isoformat(timespec="seconds")
+        time_max = (start_date + timedelta(days=1)).astimezone(timezone.utc).isoformat(timespec="seconds")
+    else:
+        time_min = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        time_max = None
+    return query_event_index(email.lower(), time_min, time_max, page, page_size)
 
 async def list_user_events(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0):
     try:
@@ -892,7 +3277,7 @@ async def list_user_events(update: Update, context: ContextTypes.DEFAULT_TYPE, p
             context.user_data["cancelamento"] = {"etapa": "email", "page": page}
             return
         page_size = 5
-        events, total_events = get_user_events(email, None, page, page_size)
+        events, total_events = await run_ledger(get_user_events, email, None, page, page_size)
         if not events:
             await update.effective_message.reply_text(
                 f"❌ Nenhum agendamento encontrado para o e-mail **{email}**.",
@@ -904,14 +3289,14 @@ async def list_user_events(update: Update, context: ContextTypes.DEFAULT_TYPE, p
         total_pages = (total_events + page_size - 1) // page_size
         page = max(0, min(page, total_pages - 1))
         keyboard = []
+        listed_events = {}
         for event in events:
-            try:
-                start_time = datetime.fromisoformat(event["start"]["dateTime"].replace("Z", "+00:00")).astimezone()
-                event_str = f"{start_time.strftime('%d/%m/%Y %H:%M')} - {event.get('summary', 'Evento sem título')}"
-                keyboard.append([InlineKeyboardButton(event_str, callback_data=f"confirm_cancel_{event['id']}")])
-            except ValueError:
+            if not get_event_start(event):
                 logger.warning(f"Evento com formato de data/hora inválido: {event.get('summary', 'Sem título')}")
                 continue
+            event_str = describe_event(event)
+            listed_events[event["id"]] = {"event_str": event_str, "event": {"id": event["id"], "start": event["start"]}}
+            keyboard.append([InlineKeyboardButton(event_str, callback_data=f"confirm_cancel_{event['id']}")])
         nav_buttons = []
         if page > 0:
             nav_buttons.append(InlineKeyboardButton("◄ Anterior", callback_data=f"cancel_all_{page-1}"))
@@ -934,23 +3319,24 @@ async def list_user_events(update: Update, context: ContextTypes.DEFAULT_TYPE, p
                 parse_mode="Markdown"
             )
         context.user_data["cancelamento"]["page"] = page
+        context.user_data["cancelamento"]["eventos"] = listed_events
     except Exception as e:
         logger.error(f"Erro em list_user_events: {str(e)}\n{traceback.format_exc()}")
         await send_error_message(update, context, "ao listar os agendamentos")
         context.user_data.pop("cancelamento", None)
 
+async def get_listed_event(context: ContextTypes.DEFAULT_TYPE, event_id):
+    listed = context.user_data.get("cancelamento", {}).get("eventos", {}).get(event_id)
+    if listed:
+        return listed["event"], listed["event_str"]
+    event = await run_calendar(calendar_get_event, event_id)
+    if not get_event_start(event):
+        logger.warning(f"Evento ID {event_id} sem detalhes de data/hora ao cancelar.")
+    return event, describe_event(event)
+
 async def confirm_cancel_appointment(update: Update, context: ContextTypes.DEFAULT_TYPE, event_id):
     try:
-        service = get_calendar_service()
-        if not service:
-            raise Exception("Serviço do Google Calendar não disponível")
-        event = service.events().get(calendarId=CALENDAR_ID, eventId=event_id).execute()
-        if 'start' in event and 'dateTime' in event['start']:
-            start_time = datetime.fromisoformat(event["start"]["dateTime"].replace("Z", "+00:00")).astimezone()
-            event_str = f"{start_time.strftime('%d/%m/%Y %H:%M')} - {event.get('summary', 'Evento sem título')}"
-        else:
-            event_str = f"Evento ID: {event_id} (Detalhes de data/hora não disponíveis)"
-            logger.warning(f"Evento ID {event_id} sem detalhes de data/hora ao cancelar.")
+        _, event_str = await get_listed_event(context, event_id)
         cancelamento = context.user_data.get("cancelamento", {})
         email = cancelamento.get("email")
         page = cancelamento.get("page", 0)
@@ -958,7 +3344,8 @@ async def confirm_cancel_appointment(update: Update, context: ContextTypes.DEFAU
             "etapa": "confirmar_cancelamento",
             "email": email,
             "page": page,
-            "event_id": event_id
+            "event_id": event_id,
+            "eventos": cancelamento.get("eventos", {}),
         }
         keyboard = [
             [InlineKeyboardButton("✅ Sim, cancelar", callback_data=f"execute_cancel_{event_id}")],
@@ -977,18 +3364,15 @@ async def confirm_cancel_appointment(update: Update, context: ContextTypes.DEFAU
 
 async def execute_cancel_appointment(update: Update, context: ContextTypes.DEFAULT_TYPE, event_id):
     try:
-        service = get_calendar_service()
-        if not service:
-            raise Exception("Serviço do Google Calendar não disponível")
-        event = service.events().get(calendarId=CALENDAR_ID, eventId=event_id).execute()
-        if 'start' in event and 'dateTime' in event['start']:
-            start_time = datetime.fromisoformat(event["start"]["dateTime"].replace("Z", "+00:00")).astimezone()
-            event_str = f"{start_time.strftime('%d/%m/%Y %H:%M')} - {event.get('summary', 'Evento sem título')}"
-        else:
-            event_str = f"Evento ID: {event_id} (Detalhes de data/hora não disponíveis)"
-            logger.warning(f"Evento ID {event_id} sem detalhes de data/hora ao cancelar.")
-        service.events().delete(calendarId=CALENDAR_ID, eventId=event_id).execute()
+        event, event_str = await get_listed_event(context, event_id)
+        try:
+            await run_calendar(calendar_delete_event, event_id, event)
+        except asyncio.TimeoutError:
+            # A exclusão pode ter sido concluída depois do tempo esgotado; confere antes de relatar erro
+            if not await run_calendar(calendar_event_deleted, event_id):
+                raise
         logger.info(f"Evento ID {event_id} cancelado com sucesso.")
+        await publish_cancelled_events([event])
         cancelamento = context.user_data.get("cancelamento", {})
         email = cancelamento.get("email", "desconhecido")
         page = cancelamento.get("page", 0)
@@ -1020,6 +3404,7 @@ async def send_error_message(update: Update, context: ContextTypes.DEFAULT_TYPE,
 # --- HANDLERS PRINCIPAIS ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
+        await clear_scheduling_state(context)
         context.user_data.clear()
         if os.path.exists(IMAGE_PATH):
             try:
@@ -1060,7 +3445,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if user_msg in MAIN_MENU_CATEGORIES:
             logger.info(f"Comando de menu principal recebido: {user_msg}")
             context.user_data.pop("cancelamento", None)
-            context.user_data.pop("agendamento", None)
+            await clear_scheduling_state(context)
             context.user_data.pop("feedback", None)
             context.user_data.pop("current_month", None)
             if user_msg == "🚪 Sair":
@@ -1081,8 +3466,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     "1. Clique em 'Agendar Atendimento' para escolher uma data e horário.\n"
                     "2. No calendário, selecione um dia disponível:\n"
                     "   - Dias disponíveis aparecem com o número (ex.: 23).\n"
-                    "   - Dias lotados são marcados com X (ex.: 19X).\n"
+                    "   - Dias lotados são marcados com X (ex.: 19X); toque neles para entrar na lista de espera e ser avisado quando vagar.\n"
                     "   - Dias passados são marcados com () (ex.: (18)).\n"
+                    "   - Ou toque em '⚡ Próximos horários livres' para ver os primeiros horários disponíveis.\n"
                     "3. Escolha um horário disponível e confirme seus dados.\n"
                     "4. Para cancelar, use 'Cancelar Agendamento' e selecione o atendimento.\n\n"
                     "Selecione um dia disponível: (X indica agenda cheia, () indica data passada)"
@@ -1102,6 +3488,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode="Markdown",
             )
             return
+        touch_scheduling(update, context)
         if context.user_data.get("agendamento", {}).get("etapa") == "email":
             if not is_valid_email(user_msg):
                 keyboard = [[InlineKeyboardButton("🔙 Voltar ao Menu", callback_data="main_menu")]]
@@ -1120,7 +3507,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if "horario" not in context.user_data["agendamento"]:
                 logger.error("Chave 'horario' não encontrada")
                 await send_error_message(update, context, "ao processar o horário do agendamento")
-                context.user_data.pop("agendamento", None)
+                await clear_scheduling_state(context)
                 return
             data_str, hora_str = context.user_data["agendamento"]["horario"].split()
             try:
@@ -1225,7 +3612,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             is_part_of_active_flow = True
     if active_state and not is_part_of_active_flow and not is_main_menu_callback and not data.startswith("confirm_cancel_"):
         logger.info(f"Callback '{data}' durante fluxo ativo. Limpando estados.")
-        context.user_data.pop("agendamento", None)
+        await clear_scheduling_state(context)
         context.user_data.pop("cancelamento", None)
         context.user_data.pop("feedback", None)
         context.user_data.pop("current_month", None)
@@ -1237,6 +3624,8 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         except Exception as edit_error:
             logger.warning(f"Não foi possível editar mensagem: {str(edit_error)}\n{traceback.format_exc()}")
+    if is_scheduling_callback:
+        touch_scheduling(update, context)
     try:
         if data == "how_it_works":
             message = (
@@ -1244,8 +3633,9 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "1. Clique em 'Agendar Atendimento' para escolher uma data e horário.\n"
                 "2. No calendário, selecione um dia disponível:\n"
                 "   - Dias disponíveis aparecem com o número (ex.: 23).\n"
-                "   - Dias lotados são marcados com X (ex.: 19X).\n"
+                "   - Dias lotados são marcados com X (ex.: 19X); toque neles para entrar na lista de espera e ser avisado quando vagar.\n"
                 "   - Dias passados são marcados com () (ex.: (18)).\n"
+                "   - Ou toque em '⚡ Próximos horários livres' para ver os primeiros horários disponíveis.\n"
                 "3. Escolha um horário disponível e confirme seus dados.\n"
                 "4. Para cancelar, use 'Cancelar Agendamento' e selecione o atendimento.\n\n"
                 "Selecione uma opção abaixo:"
@@ -1275,6 +3665,36 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 year += 1
             context.user_data["current_month"] = {"year": year, "month": month}
             await show_month_calendar(update, context)
+        elif data == "cal_next_slots":
+            await show_next_available_slots(update, context)
+        elif data.startswith("cal_wait_"):
+            parts = data.split("_")
+            if len(parts) in (5, 6):
+                try:
+                    year, month, day = map(int, parts[2:5])
+                    await subscribe_waitlist(update, context, year, month, day, parts[5] if len(parts) == 6 else None)
+                except ValueError:
+                    logger.error(f"Erro ao converter data: {data}")
+                    await send_error_message(update, context, "ao entrar na lista de espera")
+            else:
+                logger.error(f"Formato inválido para cal_wait: {data}")
+                await send_error_message(update, context, "ao entrar na lista de espera")
+        elif data.startswith("cal_offer_"):
+            await accept_waitlist_offer(update, context, data[len("cal_offer_"):])
+        elif data.startswith("cal_decline_"):
+            await decline_waitlist_offer(update, context, data[len("cal_decline_"):])
+        elif data.startswith("cal_seats_") or data.startswith("cal_weeks_"):
+            option, value = data[len("cal_"):].split("_")
+            try:
+                value = int(value)
+            except ValueError:
+                logger.error(f"Formato inválido para opção de agendamento: {data}")
+                await send_error_message(update, context, "ao ajustar as opções do agendamento")
+            else:
+                if option == "seats":
+                    await update_booking_options(update, context, seats=value)
+                else:
+                    await update_booking_options(update, context, weeks=value)
         elif data.startswith("cal_day_"):
             parts = data.split("_")
             if len(parts) == 5:
@@ -1355,7 +3775,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await send_error_message(update, context, "ao navegar no submenu")
         elif data == "main_menu":
             logger.info("Callback 'main_menu' recebida.")
-            context.user_data.pop("agendamento", None)
+            await clear_scheduling_state(context)
             context.user_data.pop("cancelamento", None)
             context.user_data.pop("feedback", None)
             context.user_data.pop("current_month", None)
@@ -1489,11 +3909,27 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 def main():
     try:
         initialize_embeddings()
+        init_event_index()
+        init_booking_ledger()
+        start_invalidation_listener()
+        start_slot_freed_listener()
         app = ApplicationBuilder().token(TOKEN).build()
         app.add_handler(CommandHandler("start", start))
         app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
         app.add_handler(CallbackQueryHandler(handle_callback))
         app.add_error_handler(error_handler)
+        if CALENDAR_WEBHOOK_URL and not CALENDAR_WEBHOOK_TOKEN:
+            logger.error("CALENDAR_WEBHOOK_TOKEN é obrigatório com CALENDAR_WEBHOOK_URL; notificações push desativadas")
+        elif CALENDAR_WEBHOOK_URL:
+            start_notification_server()
+            renew_interval = max(60, CALENDAR_CHANNEL_TTL_SECONDS // 4)
+            app.job_queue.run_repeating(renew_calendar_watch, interval=renew_interval, first=1, data={"interval": renew_interval})
+        app.job_queue.run_repeating(reconcile_event_index, interval=EVENT_INDEX_RECONCILE_INTERVAL, first=EVENT_INDEX_RECONCILE_INTERVAL)
+        app.job_queue.run_repeating(log_availability_cache_stats, interval=AVAILABILITY_STATS_INTERVAL, first=AVAILABILITY_STATS_INTERVAL)
+        app.job_queue.run_repeating(sync_pending_bookings, interval=BOOKING_SYNC_INTERVAL, first=1)
+        app.job_queue.run_repeating(notify_waitlist, interval=WAITLIST_NOTIFY_INTERVAL, first=WAITLIST_NOTIFY_INTERVAL)
+        app.job_queue.run_repeating(sweep_waitlist_offers, interval=WAITLIST_OFFER_TTL, first=WAITLIST_OFFER_TTL)
+        app.job_queue.run_once(prewarm_availability, when=random.uniform(1, 5), data={}, name="prewarm_availability")
         logger.info("Bot iniciado. Iniciando polling...")
         app.run_polling(allowed_updates=Update.ALL_TYPES)
     except Exception as e:
@@ -0,0 +1,77 @@
+import pytest
+
+
+@pytest.fixture
+def chatbot(tmp_path, monkeypatch):
+    """Módulo do bot com livro, índice e espelho isolados num diretório temporário."""
+    module = pytest.importorskip("chatbot_corrigido")
+    monkeypatch.setattr(module, "EVENT_INDEX_DB", str(tmp_path / "eventos.db"))
+    monkeypatch.setattr(module, "BOOKING_LEDGER_DB", str(tmp_path / "eventos.db"))
+    monkeypatch.setattr(module, "calendar_mirror", {"events": {}, "by_date": {}, "sync_token": None, "last_sync": None})
+    monkeypatch.setattr(module, "push_channel", {"id": None, "resource_id": None, "expiration": None})
+    module.init_event_index()
+    module.init_booking_ledger()
+    return module
+
+
+class FakeRequest:
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self):
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+class FakeEvents:
+    """events() do Calendar: list() devolve as páginas configuradas, na ordem dos pageTokens."""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+
+    def list(self, **params):
+        self.calls.append(params)
+        index = int(params.get("pageToken") or 0)
+        page = self.pages[index]
+        if isinstance(page, Exception):
+            return FakeRequest(page)
+        result = {"items": page}
+        if index + 1 < len(self.pages):
+            result["nextPageToken"] = str(index + 1)
+        else:
+            result["nextSyncToken"] = f"sync-{len(self.calls)}"
+        return FakeRequest(result)
+
+
+class FakeService:
+    def __init__(self, pages):
+        self.fake_events = FakeEvents(pages)
+
+    def events(self):
+        return self.fake_events
+
+
+@pytest.fixture
+def fake_calendar(chatbot, monkeypatch):
+    """Troca o serviço do Google por um falso; chame com a lista de páginas a devolver."""
+    def install(pages):
+        service = FakeService(pages)
+        monkeypatch.setattr(chatbot, "require_calendar_service", lambda: service)
+        return service.fake_events
+    return install
+
+
+@pytest.fixture
+def make_event():
+    def build(event_id, start, end, email="cliente@example.com"):
+        return {
+            "id": event_id,
+            "status": "confirmed",
+            "summary": "Atendimento",
+            "description": f"E-mail: {email}",
+            "start": {"dateTime": start},
+            "end": {"dateTime": end},
+        }
+    return build
@@ -0,0 +1,29 @@
+import pytest
+
+chatbot = pytest.importorskip("chatbot_corrigido")
+
+
+def test_cache_write_counts_expirations_and_evictions():
+    clock = [0]
+    cache = chatbot.AvailabilityCache(maxsize=2, ttl=10, timer=lambda: clock[0])
+    cache["a"] = 1
+    cache.update({"b": 2})
+    cache["c"] = 3
+    assert cache.stats["evictions"] == 1
+    clock[0] = 20
+    cache["d"] = 4
+    assert cache.stats["expirations"] == 2
+    assert list(cache) == ["d"]
+
+
+def test_busy_info_keeps_same_day_of_month_apart(chatbot):
+    from datetime import date, datetime
+
+    full_day, free_day = date(2030, 1, 7), date(2030, 2, 7)
+    full = {"slots": chatbot.new_occupancy(), "total": chatbot.MAX_APPOINTMENTS_PER_DAY, "capacity": None, "fetched_at": 0}
+    free = {"slots": chatbot.new_occupancy(), "total": 0, "capacity": None, "fetched_at": 0}
+    busy_info = chatbot.assemble_busy_info({full_day: full, free_day: free})
+    assert chatbot.get_day_total(busy_info, full_day) == chatbot.MAX_APPOINTMENTS_PER_DAY
+    assert chatbot.get_day_total(busy_info, free_day) == 0
+    found = chatbot.scan_available_slots(busy_info, [full_day, free_day], datetime(2030, 1, 1), 1)
+    assert [slot.date() for slot in found] == [free_day]
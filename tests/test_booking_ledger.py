@@ -0,0 +1,99 @@
+import sqlite3
+from datetime import date, datetime
+
+import pytest
+
+from googleapiclient.errors import HttpError
+
+DAY = date(2030, 1, 7)
+
+
+@pytest.fixture
+def slot(chatbot):
+    return chatbot.POSSIBLE_SLOTS[0]
+
+
+def commit(chatbot, slot, keys, capacity=1, seats=1, occurrences=None):
+    return chatbot.commit_bookings(
+        "Maria", "11999990000", "maria@example.com", slot, occurrences or [(DAY, capacity)], seats, keys
+    )
+
+
+def ledger_rows(chatbot):
+    conn = sqlite3.connect(chatbot.BOOKING_LEDGER_DB)
+    try:
+        return conn.execute("SELECT vaga, status, event_id FROM agendamentos ORDER BY id").fetchall()
+    finally:
+        conn.close()
+
+
+def test_commit_respects_slot_capacity(chatbot, slot):
+    assert commit(chatbot, slot, ["k1"], capacity=2)[1] is True
+    assert commit(chatbot, slot, ["k2"], capacity=2)[1] is True
+    assert commit(chatbot, slot, ["k3"], capacity=2) == (None, False)
+
+
+def test_commit_allocates_free_seats_all_or_nothing(chatbot, slot):
+    commit(chatbot, slot, ["a0", "a1"], capacity=3, seats=2)
+    assert commit(chatbot, slot, ["b0", "b1"], capacity=3, seats=2) == (None, False)
+    commit(chatbot, slot, ["c0"], capacity=3)
+    assert [vaga for vaga, _, _ in ledger_rows(chatbot)] == [0, 1, 2]
+
+
+def test_commit_counts_external_mirror_events(chatbot, slot):
+    hour, minute = map(int, slot.split(":"))
+    chatbot.apply_event_to_mirror({
+        "id": "externo",
+        "status": "confirmed",
+        "start": {"dateTime": datetime(DAY.year, DAY.month, DAY.day, hour, minute).isoformat()},
+        "end": {"dateTime": datetime(DAY.year, DAY.month, DAY.day, hour + 1, minute).isoformat()},
+    })
+    assert commit(chatbot, slot, ["k1"]) == (None, False)
+
+
+def test_commit_replay_returns_existing_bookings(chatbot, slot):
+    booking_ids, created = commit(chatbot, slot, ["k1"])
+    assert created is True
+    assert commit(chatbot, slot, ["k1"]) == (booking_ids, False)
+    assert chatbot.find_bookings_by_keys(["k1"]) == booking_ids
+
+
+def test_cancel_before_replication_and_while_syncing(chatbot, slot, monkeypatch):
+    (booking_id,), _ = commit(chatbot, slot, ["k1"])
+
+    class Response(dict):
+        status = 404
+        reason = "Not Found"
+
+    class Events:
+        def delete(self, **params):
+            class Request:
+                def execute(self):
+                    raise HttpError(Response(), b"")
+            return Request()
+
+    class Service:
+        def events(self):
+            return Events()
+
+    monkeypatch.setattr(chatbot, "require_calendar_service", lambda: Service())
+    # Ainda não está no Google: o 404 cancela só no livro
+    chatbot.calendar_delete_event("k1")
+    assert ledger_rows(chatbot) == [(0, "cancelado", "k1")]
+    # O worker que inseria o evento em paralelo não pode ressuscitar o agendamento
+    assert chatbot.mark_booking_synced(booking_id, "k1") is False
+    assert ledger_rows(chatbot) == [(0, "cancelado", "k1")]
+    # A vaga volta a ficar livre
+    assert commit(chatbot, slot, ["k2"])[1] is True
+
+
+def test_user_events_come_from_local_index_during_outage(chatbot, slot, monkeypatch):
+    commit(chatbot, slot, ["k1"])
+
+    def calendar_down():
+        raise AssertionError("a listagem não deve chamar o Google")
+
+    monkeypatch.setattr(chatbot, "require_calendar_service", calendar_down)
+    events, total = chatbot.get_user_events("Maria@Example.com")
+    assert total == 1
+    assert [event["id"] for event in events] == ["k1"]
@@ -0,0 +1,18 @@
+import asyncio
+import time
+
+
+def test_burst_waiting_for_a_slot_does_not_time_out(chatbot, monkeypatch):
+    monkeypatch.setattr(chatbot, "calendar_semaphore", None)
+    monkeypatch.setattr(chatbot, "calendar_breaker", {"failures": 0, "opened_at": None, "trial_in_progress": False})
+
+    def slow_call():
+        time.sleep(0.2)
+        return "ok"
+
+    async def burst():
+        calls = [chatbot.run_calendar(slow_call, timeout=0.5) for _ in range(chatbot.CALENDAR_MAX_WORKERS * 3)]
+        return await asyncio.gather(*calls)
+
+    assert set(asyncio.run(burst())) == {"ok"}
+    assert chatbot.calendar_breaker["failures"] == 0
@@ -0,0 +1,45 @@
+from datetime import date
+
+import pytest
+
+from googleapiclient.errors import HttpError
+
+
+def http_error(status):
+    class Response(dict):
+        pass
+    response = Response()
+    response.status = status
+    response.reason = "erro"
+    return HttpError(response, b"")
+
+
+def test_failed_full_sync_keeps_previous_mirror_and_refetches(chatbot, fake_calendar, make_event):
+    fake_calendar([[
+        make_event("a", "2030-01-07T09:00:00-03:00", "2030-01-07T10:00:00-03:00"),
+        make_event("b", "2030-01-07T11:00:00-03:00", "2030-01-07T12:00:00-03:00"),
+    ]])
+    chatbot.sync_calendar_mirror(full=True)
+
+    fake_calendar([[make_event("a", "2030-01-07T09:00:00-03:00", "2030-01-07T10:00:00-03:00")], http_error(500)])
+    with pytest.raises(HttpError):
+        chatbot.sync_calendar_mirror(full=True)
+    assert set(chatbot.calendar_mirror["events"]) == {"a", "b"}
+
+    events = fake_calendar([[]])
+    chatbot.sync_calendar_mirror()
+    assert events.calls, "a sincronização seguinte deve buscar de novo no Google"
+
+
+def test_full_sync_reports_only_changed_dates(chatbot, fake_calendar, make_event):
+    fake_calendar([[
+        make_event("a", "2030-01-07T09:00:00-03:00", "2030-01-07T10:00:00-03:00"),
+        make_event("b", "2030-01-08T09:00:00-03:00", "2030-01-08T10:00:00-03:00"),
+    ]])
+    chatbot.sync_calendar_mirror(full=True)
+
+    fake_calendar([[
+        make_event("a", "2030-01-07T11:00:00-03:00", "2030-01-07T12:00:00-03:00"),
+        make_event("b", "2030-01-08T09:00:00-03:00", "2030-01-08T10:00:00-03:00"),
+    ]])
+    assert chatbot.sync_calendar_mirror(full=True) == {date(2030, 1, 7)}
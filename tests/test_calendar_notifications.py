@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+
+@pytest.fixture
+def webhook(chatbot, monkeypatch):
+    """Notificador falso: o canal ativo é 'canal-1' e o Redis não tem outro canal registrado."""
+    monkeypatch.setattr(chatbot, "CALENDAR_WEBHOOK_TOKEN", "segredo")
+    monkeypatch.setattr(chatbot, "load_shared_push_channel", lambda: True)
+    chatbot.push_channel.update({"id": "canal-1", "resource_id": "r1", "expiration": time.time() + 3600})
+    synced = []
+
+    def fake_sync(force=False, full=False):
+        synced.append(force)
+        return set()
+
+    monkeypatch.setattr(chatbot, "sync_calendar_mirror", fake_sync)
+
+    def notify(channel_id="canal-1", token="segredo", state="exists"):
+        return chatbot.handle_calendar_notification({
+            "X-Goog-Channel-ID": channel_id,
+            "X-Goog-Channel-Token": token,
+            "X-Goog-Resource-State": state,
+        })
+    notify.synced = synced
+    return notify
+
+
+def test_notification_triggers_forced_sync(webhook):
+    assert webhook() == 200
+    assert webhook.synced == [True]
+
+
+def test_sync_handshake_does_not_sync(webhook):
+    assert webhook(state="sync") == 200
+    assert webhook.synced == []
+
+
+def test_unknown_channel_and_bad_token_are_rejected(webhook):
+    assert webhook(channel_id="outro") == 404
+    assert webhook(token="errado") == 403
+    assert webhook(token="") == 403
+    assert webhook.synced == []
+
+
+def test_channel_renewed_by_another_worker_is_accepted(chatbot, webhook, monkeypatch):
+    def renewed_elsewhere():
+        chatbot.push_channel["id"] = "canal-2"
+        return True
+
+    monkeypatch.setattr(chatbot, "load_shared_push_channel", renewed_elsewhere)
+    assert webhook(channel_id="canal-2") == 200
+
+
+def test_failed_sync_forces_next_sync(chatbot, webhook, monkeypatch):
+    def failing_sync(force=False, full=False):
+        raise RuntimeError("Google indisponível")
+
+    monkeypatch.setattr(chatbot, "sync_calendar_mirror", failing_sync)
+    chatbot.calendar_mirror["last_sync"] = time.monotonic()
+    assert webhook() == 200
+    assert chatbot.calendar_mirror["last_sync"] is None
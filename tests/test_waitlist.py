@@ -0,0 +1,25 @@
+from datetime import date
+
+DAY = date(2030, 1, 7)
+
+
+def test_failed_hold_keeps_head_of_waitlist(chatbot):
+    slot = chatbot.POSSIBLE_SLOTS[0]
+    chatbot.add_waitlist_entry(1, 1, "Ana", "11999990001", DAY, slot)
+    chatbot.add_waitlist_entry(2, 2, "Bia", "11999990002", DAY, slot)
+
+    entry_id, user_id, *_, offered_at, offered_slot = chatbot.claim_waitlist_entry(DAY, slot)
+    assert user_id == 1
+    # A vaga escapou antes da reserva: Ana nunca recebeu oferta e continua na frente
+    chatbot.unclaim_waitlist_entry(entry_id, offered_at, offered_slot)
+    assert chatbot.claim_waitlist_entry(DAY, slot)[1] == 1
+
+
+def test_requeued_offer_goes_behind_unoffered_subscribers(chatbot):
+    slot = chatbot.POSSIBLE_SLOTS[0]
+    chatbot.add_waitlist_entry(1, 1, "Ana", "11999990001", DAY, slot)
+    chatbot.add_waitlist_entry(2, 2, "Bia", "11999990002", DAY, slot)
+
+    entry_id = chatbot.claim_waitlist_entry(DAY, slot)[0]
+    chatbot.requeue_waitlist_entry(entry_id)
+    assert chatbot.claim_waitlist_entry(DAY, slot)[1] == 2